@@ -6,8 +6,30 @@ latter case.
 
 Originally written by Alex Plotnick.
 
+The align() function is the original implementation and fast_align() is an
+implementation of the same algorithm that uses numpy arrays and that can limit
+the search to a band around the diagonal. The align_indexes() function finds the
+same alignment as fast_align() but returns lists of indexes into the sequences.
+
 """
 
+import numpy as np
+
+
+# Traceback moves for fast_align(), the order of the first three is the order in
+# which align() breaks ties between moves.
+DIAG = 0
+UP = 1
+LEFT = 2
+
+# Score used for cells outside of the band, low enough that it will never be
+# picked but not so low that adding a few gap penalties overflows.
+MINUS_INFINITY = -(1 << 40)
+
+# Index used by align_indexes() for positions where an element is aligned with a
+# gap.
+GAP = -1
+
 
 def align(a, b, d=-5, s=lambda x,y: x==y, key=lambda x: x, gap=None):
     """Find the globally optimal alignment between the two sequences a and b
@@ -59,24 +81,229 @@ def align(a, b, d=-5, s=lambda x,y: x==y, key=lambda x: x, gap=None):
     return aligned_a, aligned_b
 
 
-def levenshtein_distance(a, b):
-    """Compute the Levenshtein edit distance between the sequences a and b."""
-    m = len(a) + 1
-    n = len(b) + 1
+def fast_align(a, b, d=-5, s=None, key=None, gap=None, band=None):
+    """Find the globally optimal alignment between the two sequences a and b, this
+    gives the same result as align(a, b, d, s, key, gap), but it fills in the
+    alignment matrix with numpy operations on entire rows and keeps the traceback
+    moves in an array of bytes.
 
-    d = [[0]*n for _ in range(m)]
-    for i in range(m): d[i][0] = i # deletion
-    for j in range(n): d[0][j] = j # insertion
+    If s and key are not given then the similarity of two elements is 1 if they
+    are equal and 0 otherwise, which is what align() does by default. This case
+    is quite a bit faster since similarities can be computed without a Python
+    call for each pair of elements.
 
-    for i in range(1, m):
-        for j in range(1, n):
+    If band is given then only cells (i, j) where j - i is no more than band away
+    from the range between 0 and len(b) - len(a) are considered. This is much
+    faster for long sequences, but the alignment is not guaranteed to be optimal
+    if the best path leaves the band."""
+    moves = alignment_moves(a, b, d, s, key, band)
+    aligned_a, aligned_b = traceback(a, b, moves, gap)
+    if isinstance(a, str) and isinstance(b, str):
+        def default_gap(x): return x if x is not None else "-"
+        return ("".join(map(default_gap, aligned_a)),
+                "".join(map(default_gap, aligned_b)))
+    return aligned_a, aligned_b
+
+
+def align_indexes(a, b, d=-5, s=None, key=None, band=None):
+    """Find the same alignment as fast_align(a, b, d, s, key, band=band), but
+    return two lists of integers of the same length, with for each position in
+    the alignment the index of the element of a and the index of the element of b,
+    or GAP if the element of the other sequence is aligned with a gap."""
+    moves = alignment_moves(a, b, d, s, key, band)
+    return traceback_indexes(len(a), len(b), moves)
+
+
+def alignment_moves(a, b, d=-5, s=None, key=None, band=None):
+    """Fill in the alignment matrix and return the traceback moves."""
+    m = len(a)
+    n = len(b)
+    similarities = similarity_rows(a, b, s, key)
+    moves = np.empty((m + 1, n + 1), dtype=np.int8)
+    moves[0, :] = LEFT
+    moves[1:, 0] = UP
+    # The lowest and highest legal values of j - i for all cells.
+    lowest = min(0, n - m) - band if band is not None else -m
+    highest = max(0, n - m) + band if band is not None else n
+    # We only need to keep the scores for the previous and current row.
+    previous = np.full(n + 1, MINUS_INFINITY, dtype=np.int64)
+    previous[:highest+1] = d * np.arange(min(n, highest) + 1)
+    for i in range(1, m + 1):
+        current = np.full(n + 1, MINUS_INFINITY, dtype=np.int64)
+        if i + lowest <= 0:
+            current[0] = d * i
+        j1 = max(1, i + lowest)
+        j2 = min(n, i + highest)
+        if j1 > j2:
+            previous = current
+            continue
+        diag = previous[j1-1:j2] + similarities(i - 1, j1 - 1, j2)
+        up = previous[j1:j2+1] + d
+        best = np.maximum(diag, up)
+        moves[i, j1:j2+1] = np.where(diag >= up, DIAG, UP)
+        # Moves from the left are chained, with f(j) = max(best(j), f(j-1) + d)
+        # for each cell. Subtracting d * j from each value turns this into a
+        # running maximum.
+        steps = np.arange(j2 - j1 + 2)
+        scores = np.concatenate(([current[j1-1]], best))
+        scores = np.maximum.accumulate(scores - d * steps) + d * steps
+        current[j1:j2+1] = scores[1:]
+        moves[i, j1:j2+1][scores[1:] > best] = LEFT
+        previous = current
+    return moves
+
+
+def similarity_rows(a, b, s=None, key=None):
+    """Return a function that takes an index i of a and a range j1 to j2 of
+    indexes of b and returns an array with the similarities of a[i] and the
+    elements b[j1:j2]. Only the similarities that are asked for are computed, so
+    no similarities are computed for cells outside of the band and there is never
+    a matrix with all pairs. With the default similarity the array has booleans,
+    which numpy turns into integers when they are added to the scores, otherwise
+    it has the integers returned by s."""
+    if s is None and key is None:
+        try:
+            # Map all elements to integer codes so that numpy can compare them.
+            codes = {}
+            codes_a = [codes.setdefault(x, len(codes)) for x in a]
+            codes_b = np.array([codes.setdefault(y, len(codes)) for y in b], dtype=np.int64)
+            return lambda i, j1, j2: codes_b[j1:j2] == codes_a[i]
+        except TypeError:
+            # Elements are not hashable.
+            pass
+    s = s if s is not None else lambda x, y: x == y
+    key = key if key is not None else lambda x: x
+    keys_a = [key(x) for x in a]
+    keys_b = [key(y) for y in b]
+    def row(i, j1, j2):
+        return np.array([s(keys_a[i], y) for y in keys_b[j1:j2]], dtype=np.int64)
+    return row
+
+
+def traceback(a, b, moves, gap=None):
+    """Decode the traceback moves starting from the lower right-hand corner and
+    return the aligned sequences."""
+    indexes_a, indexes_b = traceback_indexes(len(a), len(b), moves)
+    aligned_a = [a[i] if i != GAP else gap for i in indexes_a]
+    aligned_b = [b[j] if j != GAP else gap for j in indexes_b]
+    return aligned_a, aligned_b
+
+
+def traceback_indexes(m, n, moves):
+    """Decode the traceback moves for sequences of length m and n and return the
+    aligned indexes."""
+    i = m
+    j = n
+    indexes_a = []; indexes_b = []
+    while i > 0 or j > 0:
+        move = moves[i, j]
+        if move == DIAG:
+            i -= 1; j -= 1
+            indexes_a.append(i); indexes_b.append(j)
+        elif move == UP:
+            i -= 1
+            indexes_a.append(i); indexes_b.append(GAP)
+        else:
+            j -= 1
+            indexes_a.append(GAP); indexes_b.append(j)
+    indexes_a.reverse(); indexes_b.reverse()
+    return indexes_a, indexes_b
+
+
+def levenshtein_distance(a, b, max_distance=None):
+    """Compute the Levenshtein edit distance between the sequences a and b.
+
+    If max_distance is given then the computation stops as soon as it is clear
+    that the distance is larger than max_distance, and for all those cases
+    max_distance + 1 is returned.
+
+    This uses the bit-parallel algorithm by Myers (as formulated by Hyyrö) when
+    the elements of the sequences are hashable, where a column of the distance
+    matrix is kept in the bits of a few integers. Otherwise it uses the standard
+    dynamic programming algorithm but only keeps two rows of the matrix."""
+    # Common prefixes and suffixes do not contribute to the distance.
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    a_end = len(a)
+    b_end = len(b)
+    while a_end > start and b_end > start and a[a_end-1] == b[b_end-1]:
+        a_end -= 1
+        b_end -= 1
+    a = a[start:a_end]
+    b = b[start:b_end]
+    # The distance is at least the difference in length.
+    if max_distance is not None and abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    # The shortest sequence is used as the pattern.
+    if len(a) > len(b):
+        a, b = b, a
+    if not a:
+        distance = len(b)
+    else:
+        try:
+            distance = _levenshtein_bit_parallel(a, b, max_distance)
+        except TypeError:
+            # Elements are not hashable.
+            distance = _levenshtein_two_rows(a, b, max_distance)
+    if max_distance is not None:
+        distance = min(distance, max_distance + 1)
+    return distance
+
+
+def _levenshtein_bit_parallel(a, b, max_distance=None):
+    """Compute the edit distance with the bit-vector algorithm. Bit i of the
+    vertical delta vectors tells whether the distance in row i+1 of the current
+    column is one more (pv) or one less (mv) than in row i. Python integers have
+    no fixed size so this works for patterns of any length."""
+    m = len(a)
+    n = len(b)
+    peq = {}
+    for i, x in enumerate(a):
+        peq[x] = peq.get(x, 0) | (1 << i)
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv = full
+    mv = 0
+    score = m
+    for j, y in enumerate(b):
+        eq = peq.get(y, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        # Each of the remaining elements of b can lower the distance by one.
+        if max_distance is not None and score - (n - j - 1) > max_distance:
+            return max_distance + 1
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+    return score
+
+
+def _levenshtein_two_rows(a, b, max_distance=None):
+    """Compute the edit distance with the dynamic programming algorithm, keeping
+    only the previous and the current row of the distance matrix."""
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
             if a[i-1] == b[j-1]:
-                d[i][j] = d[i-1][j-1]
+                current[j] = previous[j-1]
             else:
-                d[i][j] = min(d[i-1][j] + 1, # deletion
-                              d[i][j-1] + 1, # insertion
-                              d[i-1][j-1] + 1) # substitution
-    return d[m-1][n-1]
+                current[j] = min(previous[j] + 1,     # deletion
+                                 current[j-1] + 1,    # insertion
+                                 previous[j-1] + 1)   # substitution
+        # The distance can never be lower than the lowest value in a row.
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
 
 
 class Word(object):
@@ -9,24 +9,41 @@ Requirements
 
 $ pip install clams-python==0.5.1
 $ pip install fastpunct==2.0.2
+$ pip install numpy
 
 """
 
 import os
 import sys
 import json
+import queue
+import hashlib
+import itertools
 import argparse
+import threading
 
 from clams.app import ClamsApp
 from clams.restify import Restifier
 from clams.appmetadata import AppMetadata
+from mmif import __specver__
 from mmif.serialize import Mmif
 from mmif.vocabulary import DocumentTypes, AnnotationTypes
 from lapps.discriminators import Uri
-from fastpunct import FastPunct
+import numpy as np
 
-from align import align
+from align import align_indexes, GAP
 from utils import Identifiers
+from mmifjson import JsonAnnotation
+from metrics import METRICS
+import cache
+import engines
+import jobs
+import mmifjson
+import inference
+import model
+import pool
+import scheduler
+import server
 import evaluation.examples
 
 MMIF_VERSION = '0.4.0'
@@ -39,17 +56,76 @@ ANALYZER_VERSION = '2.0.2'
 ANALYZER_LICENSE = 'MIT License'
 
 
-FASTPUNCT = FastPunct()
+# The fastpunct model is loaded on a background thread so that importing this
+# module and serving metadata is fast, MODEL.get() returns the engine that runs
+# the model and waits for loading to finish if needed. Set MODEL.engine to the
+# name of another engine from the engines module before loading starts to use
+# that engine.
+MODEL = model.ModelLoader()
+
+# Pool of model replicas in separate processes. When this is set inference is
+# handed to the replicas and MODEL is not used.
+POOL = None
+
+# Scheduler that runs segments from concurrent requests in shared batches. When
+# this is set inference goes through the scheduler, which uses MODEL.
+SCHEDULER = None
+
+# Cache for fastpunct output, by default this only has an in-memory tier, use
+# CACHE.open() to add a tier on disk.
+CACHE = cache.PunctCache()
+
+# Limits how many requests in this process run inference at the same time, other
+# requests wait until a slot is free. With None there is no limit, use
+# set_inference_concurrency() to set one.
+INFERENCE_SLOTS = None
 
 
 # Maximum pause between words allowed before we insert a segment boundary
 MAX_PAUSE = 250
 
+# Number of segments that are handed to fastpunct in one call. Segments from all
+# Kaldi views in a request are collected and sorted by length before they are
+# cut into batches. With None the batch size of the decoding profile is used.
+BATCH_SIZE = None
+
+# Inference runs on its own thread in windows of PIPELINE_BATCHES batches, while
+# the thread of the request aligns the output of the windows that are done. At
+# most PIPELINE_DEPTH finished windows wait for the request thread. Windows are
+# cut from the segments sorted on length, so batches need about as little
+# padding as without windows. With None or zero all segments go through
+# fastpunct before alignment starts.
+PIPELINE_BATCHES = 8
+PIPELINE_DEPTH = 2
+
+# The decoding profile used when a request does not ask for one, see PROFILES in
+# the inference module.
+PROFILE = inference.DEFAULT_PROFILE
+
 # Maximum size of a segment. The fastpunct module doesn't do well with sequences
 # longer than 512. Since the sequence length seems to be longer than the number
 # of tokens we play it conservatively here.
 MAX_SEGMENT_SIZE = 256
 
+# How the tokens are cut into segments. With 'pause' a segment ends at each
+# pause longer than MAX_PAUSE and when it reaches MAX_SEGMENT_SIZE tokens. With
+# 'budget' the fastpunct tokenizer is used to fill segments up to SUBWORD_BUDGET
+# subword tokens (including the prefix and the end-of-sequence token), cutting at
+# the longest pause among the positions where the segment is at least MIN_FILL
+# full. This gives fewer and longer segments that never overflow the model.
+SEGMENTATION = 'pause'
+SUBWORD_BUDGET = 256
+MIN_FILL = 0.5
+
+# The tokenizer used for budget segmentation, see get_tokenizer().
+TOKENIZER = None
+
+# Band used when aligning fastpunct output with the input. With None the entire
+# alignment matrix is searched, which gives optimal alignments. Setting this to a
+# small number makes alignment faster since fastpunct output usually does not
+# drift more than a few words from the input.
+ALIGNMENT_BAND = None
+
 # We hardwire the name of the Kaldi app so we can use it to find views created
 # by Kaldi, this is not a very elegant way to do this
 KALDI_APP = 'http://apps.clams.ai/aapb-pua-kaldi-wrapper'
@@ -86,22 +162,167 @@ class App(ClamsApp):
         metadata.add_output(AnnotationTypes.TimeFrame)
         metadata.add_output(AnnotationTypes.Alignment)
         metadata.add_output(AnnotationTypes.Span)
+        metadata.add_parameter(
+            name='profile', type='string', choices=list(inference.PROFILES), default=PROFILE,
+            description="Decoding profile, 'fast' trades some quality for speed and "
+                        "'quality' uses beam search.")
+        metadata.add_parameter(
+            name='force', type='boolean', default=False,
+            description="Add a fastpunct view for each Kaldi view even if the input "
+                        "already has an up-to-date one.")
         return metadata
 
-    def _annotate(self, mmif, **kwargs):
-        Identifiers.reset()
-        self.mmif = mmif if type(mmif) is Mmif else Mmif(mmif)
-        for view in list(self.mmif.views):
-            annotation_types = [t.shortname for t in view.metadata.contains]
-            if view.metadata.app.startswith(KALDI_APP):
-                # As currently set up we do not need the document as input to
-                # fastpunct since we work from the tokens in the input view, but
-                # we hand in the input view since we want to copy some metadata.
-                new_view = self._new_view(view)
-                run_fastpunct(view, new_view)
-        return self.mmif
-
-    def _new_view(self, input_view):
+    def annotate(self, mmif, **runtime_params):
+        """This does what ClamsApp.annotate() does, but when the input is not a Mmif
+        object then mmif-python objects are only created for the parts of the
+        input that are not annotations. Annotations from the Kaldi views are read
+        straight from the JSON and all annotations from the input are copied to
+        the output as they are."""
+        METRICS.count('requests')
+        with METRICS.timer('annotate'):
+            if isinstance(mmif, Mmif):
+                return super().annotate(mmif, **runtime_params)
+            return self._annotate_json(mmif, **runtime_params)
+
+    def annotate_stream(self, mmif, **runtime_params):
+        """Like annotate(), but return the output as an iterator of strings. All
+        the work up to creating the spans, timeframes and alignments for the new
+        views is done before this returns, so errors are raised here. The rest of
+        the work is done while the output is taken from the iterator, the output
+        is only indented if the pretty parameter is set."""
+        METRICS.count('requests')
+        if isinstance(mmif, Mmif):
+            mmif = mmif.serialize()
+        pretty = runtime_params.pop('pretty') if 'pretty' in runtime_params else False
+        with METRICS.timer('annotate'):
+            mmif_obj, mmif_json = self._parse_json(mmif)
+            pending = {}
+            mmif_obj = self._annotate(mmif_obj, mmif_json=mmif_json, pending=pending,
+                                      **runtime_params)
+        chunks = mmifjson.iter_serialize(mmif_obj, mmif_json, pending, pretty=pretty)
+        return METRICS.iterate('serialize', chunks)
+
+    def _annotate_json(self, mmif, **runtime_params):
+        pretty = runtime_params.pop('pretty') if 'pretty' in runtime_params else False
+        mmif_obj, mmif_json = self._parse_json(mmif)
+        mmif_obj = self._annotate(mmif_obj, mmif_json=mmif_json, **runtime_params)
+        with METRICS.timer('serialize'):
+            return mmifjson.serialize(mmif_obj, mmif_json, pretty=pretty)
+
+    def _parse_json(self, mmif):
+        """Return the skeleton Mmif object and the JSON of the input, after checking
+        that the MMIF version of the input is compatible."""
+        with METRICS.timer('parse'):
+            mmif_json = mmifjson.load(mmif)
+            mmif_obj = Mmif(mmifjson.skeleton(mmif_json))
+        input_specver = mmif_obj.metadata.mmif.rsplit('/')[-1]
+        if 'dev' not in __specver__ \
+                and not self._check_mmif_compatibility(__specver__, input_specver):
+            raise ValueError("Input MMIF file (version %s) is not compatible with the app "
+                             "(version %s)" % (input_specver, __specver__))
+        return mmif_obj, mmif_json
+
+    def _annotate(self, mmif, mmif_json=None, progress=None, pending=None, **kwargs):
+        """Add a fastpunct view for each Kaldi view. If mmif_json is given then the
+        Kaldi tokens are taken from there instead of from the views in mmif. If
+        progress is given it is called with the number of segments that went
+        through fastpunct and the total number of segments. The decoding profile
+        can be given with the profile parameter. If pending is given it should be
+        a dictionary, the spans, timeframes and alignments of the new views are
+        then not added to the views but put in pending as generators, as expected
+        by mmifjson.iter_serialize().
+
+        Kaldi views that already have a fastpunct view from this app with the same
+        fingerprint and view parameters are skipped, unless the force parameter is
+        set. The fingerprint is taken from the words and timeframes of the Kaldi
+        view, so a view that was changed is run again.
+
+        All state of the request is kept in local variables, so several requests
+        can be annotated at the same time by different threads."""
+        profile = kwargs.get('profile') or PROFILE
+        if profile not in inference.PROFILES:
+            raise ValueError("Unknown decoding profile '%s', use one of %s"
+                             % (profile, ', '.join(inference.PROFILES)))
+        force = kwargs.get('force', False)
+        engine = get_engine_name()
+        identifiers = Identifiers()
+        mmif = mmif if type(mmif) is Mmif else Mmif(mmif)
+        kaldi_views = [view for view in list(mmif.views)
+                       if view.metadata.app.startswith(KALDI_APP)]
+        with METRICS.timer('get_annotations'):
+            if mmif_json is not None:
+                views_json = mmifjson.get_views(mmif_json)
+                tokens_per_view = [get_annotations_from_json(views_json[view.id])
+                                   for view in kaldi_views]
+            else:
+                tokens_per_view = [get_annotations(view) for view in kaldi_views]
+        fingerprints = [tokens.fingerprint() for tokens in tokens_per_view]
+        if not force:
+            done = self._get_fingerprints(mmif, profile, engine)
+            todo = [i for i, fingerprint in enumerate(fingerprints) if fingerprint not in done]
+            METRICS.count('skipped_views', len(kaldi_views) - len(todo))
+            kaldi_views = [kaldi_views[i] for i in todo]
+            tokens_per_view = [tokens_per_view[i] for i in todo]
+            fingerprints = [fingerprints[i] for i in todo]
+        # Segments from all Kaldi views are collected up front so that they can
+        # be handed to fastpunct in batches.
+        with METRICS.timer('segmentation'):
+            segments_per_view = [get_segments(tokens) for tokens in tokens_per_view]
+        METRICS.count('views', len(kaldi_views))
+        METRICS.count('tokens', sum(len(tokens) for tokens in tokens_per_view))
+        METRICS.count('segments', sum(len(segments) for segments in segments_per_view))
+        # Alignment does not depend on the order of the segments, so segments are
+        # aligned as soon as fastpunct is done with them, while fastpunct works
+        # on the next ones. Annotations are then created in document order.
+        ready = iter_punct_segments(
+            [segment for segments in segments_per_view for segment in segments],
+            progress=progress, profile=profile)
+        try:
+            for segment in ready:
+                segment.align()
+        finally:
+            ready.close()
+        for view, segments, fingerprint in zip(kaldi_views, segments_per_view, fingerprints):
+            # As currently set up we do not need the document as input to
+            # fastpunct since we work from the tokens in the input view, but
+            # we hand in the input view since we want to copy some metadata.
+            new_view = self._new_view(mmif, view, profile, engine, fingerprint)
+            deferred = run_fastpunct(segments, new_view, identifiers, defer=pending is not None)
+            if pending is not None:
+                pending[new_view.id] = iter_annotations(deferred)
+        return mmif
+
+    def _get_fingerprints(self, mmif, profile, engine):
+        """Return the fingerprints of the Kaldi views that have a fastpunct view
+        from this app that was created with the same view parameters."""
+        expected = self._view_parameters(profile, engine)
+        fingerprints = set()
+        for view in mmif.views:
+            metadata = view.metadata
+            if metadata.app != self.metadata.identifier or 'fingerprint' not in metadata:
+                continue
+            parameters = metadata.parameters
+            if all(parameters.get(name) == value for name, value in expected.items()):
+                fingerprints.add(metadata['fingerprint'])
+        return fingerprints
+
+    def _view_parameters(self, profile=None, engine=None):
+        """Return the parameters recorded in a new view, which are everything
+        that changes the output of the app. Values are strings since that is how
+        sign_view() stores them."""
+        parameters = {
+            'profile': profile or PROFILE,
+            'engine': engine or get_engine_name(),
+            'app_version': APP_VERSION,
+            'segmentation': SEGMENTATION,
+            'max_segment_size': MAX_SEGMENT_SIZE,
+            'subword_budget': SUBWORD_BUDGET,
+            'min_fill': MIN_FILL,
+            'max_pause': MAX_PAUSE,
+            'alignment_band': ALIGNMENT_BAND}
+        return {name: str(value) for name, value in parameters.items()}
+
+    def _new_view(self, mmif, input_view, profile=None, engine=None, fingerprint=None):
         # First get some goodies from the previous view, where the metadata for
         # the TimeFrame are of interest.
         document = None
@@ -112,9 +333,11 @@ class App(ClamsApp):
         if 'timeUnit' in tf_contains:
             time_unit = tf_contains['timeUnit']
         # Build the new view.
-        view = self.mmif.new_view()
+        view = mmif.new_view()
         view.metadata.app = self.metadata.identifier
-        self.sign_view(view)
+        self.sign_view(view, self._view_parameters(profile, engine))
+        if fingerprint is not None:
+            view.metadata['fingerprint'] = fingerprint
         # We know that we create one text document which is the document source
         # for all Span annotations, and the identifier for that single document
         # is going to be td1 because of how the Identifiers class works.
@@ -126,92 +349,322 @@ class App(ClamsApp):
         return view
 
 
-def run_fastpunct(view, new_view):
-    """Run the fastpunct module over the text in the view and add annotations to
+def punct_segments(segments, progress=None, profile=None):
+    """Run fastpunct in batches over the text of all segments and hand the results
+    to the segments. If progress is given it is called with the number of
+    segments done and the total number of segments."""
+    texts_out = punct_texts([segment.text() for segment in segments],
+                            progress=progress, profile=profile)
+    for segment, text_out in zip(segments, texts_out):
+        segment.set_text_out(text_out)
+
+
+def iter_punct_segments(segments, progress=None, profile=None):
+    """Generate the segments, each one after its fastpunct output was handed to
+    it. The segments are sorted on length, longest first, and cut into windows
+    of whole batches, and a separate thread runs punct_segments() on one window
+    after another, so the caller can work on the segments of a window while the
+    next windows go through fastpunct. Segments are generated in the order of
+    the windows and not in the order of the input. If the caller stops early it
+    should close the generator, which stops the thread after the window it is
+    working on. If progress is given it is called with the number of segments
+    done and the total number of segments."""
+    profile = profile or PROFILE
+    size = get_window_size(profile)
+    if size is None or len(segments) <= size:
+        punct_segments(segments, progress=progress, profile=profile)
+        yield from segments
+        return
+    # Character length is a good enough stand-in for the number of subword
+    # tokens, the batches in a window are sorted on subword tokens by inference.
+    ordered = sorted(segments, key=lambda segment: -len(segment.text()))
+    windows = [ordered[i:i + size] for i in range(0, len(ordered), size)]
+    # The thread puts None on the queue for each finished window, or the
+    # exception that stopped it.
+    results = queue.Queue(PIPELINE_DEPTH)
+    stop = threading.Event()
+    threading.Thread(target=run_windows, args=(windows, results, stop, progress, profile),
+                     name='inference-pipeline', daemon=True).start()
+    try:
+        for window in windows:
+            with METRICS.timer('pipeline_wait'):
+                error = results.get()
+            if error is not None:
+                raise error
+            yield from window
+    finally:
+        stop.set()
+        # Make room in case the thread is waiting to put a window on the queue.
+        try:
+            while True:
+                results.get_nowait()
+        except queue.Empty:
+            pass
+
+
+def run_windows(windows, results, stop, progress=None, profile=None):
+    """Run punct_segments() on each window of segments and put None on the results
+    queue when a window is done, this is what the thread started by
+    iter_punct_segments() runs."""
+    total = sum(len(window) for window in windows)
+    offset = 0
+    for window in windows:
+        if stop.is_set():
+            return
+        window_progress = None
+        if progress is not None:
+            def window_progress(done, _, offset=offset):
+                progress(offset + done, total)
+        try:
+            punct_segments(window, progress=window_progress, profile=profile)
+        except Exception as e:
+            results.put(e)
+            return
+        results.put(None)
+        offset += len(window)
+
+
+def get_window_size(profile):
+    """Return the number of segments in a window of the inference pipeline, or
+    None if there is no pipelining."""
+    if not PIPELINE_BATCHES:
+        return None
+    batches = PIPELINE_BATCHES
+    if POOL is not None:
+        # Each replica should get at least one batch of each window.
+        batches = max(batches, POOL.replicas)
+    return batches * (BATCH_SIZE or inference.PROFILES[profile]['batch_size'])
+
+
+def set_inference_concurrency(n):
+    """Allow at most n requests to run inference at the same time, with None or
+    zero there is no limit."""
+    global INFERENCE_SLOTS
+    INFERENCE_SLOTS = threading.BoundedSemaphore(n) if n else None
+
+
+def get_engine_name():
+    """Return the name of the engine that runs the model."""
+    return POOL.engine if POOL is not None else MODEL.engine
+
+
+def punct_texts(texts, progress=None, profile=None):
+    """Return the fastpunct output for all texts, using the decoding profile or
+    PROFILE if there is none. Results are taken from the cache if possible and
+    the remaining texts are handed to fastpunct in batches. If progress is given
+    it is called with the number of texts done and the total number of texts,
+    first for the cached ones and then after each batch."""
+    profile = profile or PROFILE
+    settings = inference.decoding_settings(profile)
+    settings['engine'] = get_engine_name()
+    keys = [CACHE.key(text, ANALYZER_VERSION, settings) for text in texts]
+    texts_out = [CACHE.get(key) for key in keys]
+    # Texts that are not cached, repeated texts are only run once.
+    missing = {}
+    for i, text_out in enumerate(texts_out):
+        if text_out is None:
+            missing.setdefault(keys[i], texts[i])
+    # Repeated texts count as done as soon as we have the cached texts.
+    done = len(texts) - len(missing)
+    batch_done = None
+    if progress is not None:
+        progress(done, len(texts))
+        def batch_done(n):
+            nonlocal done
+            done += n
+            progress(done, len(texts))
+    if missing:
+        slots = INFERENCE_SLOTS
+        if slots is not None:
+            with METRICS.timer('inference_wait'):
+                slots.acquire()
+        try:
+            with METRICS.timer('inference'):
+                if POOL is not None:
+                    computed = POOL.punct(list(missing.values()), batch_size=BATCH_SIZE,
+                                          progress=batch_done, profile=profile)
+                elif SCHEDULER is not None:
+                    computed = SCHEDULER.punct(list(missing.values()), progress=batch_done,
+                                               profile=profile)
+                else:
+                    computed = inference.punct(MODEL.get(), list(missing.values()),
+                                               batch_size=BATCH_SIZE, progress=batch_done,
+                                               profile=profile)
+        finally:
+            if slots is not None:
+                slots.release()
+        computed = dict(zip(missing.keys(), computed))
+        for key, text_out in computed.items():
+            CACHE.put(key, text_out)
+        texts_out = [computed[key] if text_out is None else text_out
+                     for key, text_out in zip(keys, texts_out)]
+    return texts_out
+
+
+def run_fastpunct(segments, new_view, identifiers, defer=False):
+    """Use the output of fastpunct on the segments of a view and add annotations to
     the new view, including a TextDocument and the individual token-like spans as
-    well as all time frames that the spans are aligned to."""
-    segments = get_segments(view)
-    new_document, new_timeframe = add_toplevel_annotations(new_view)
+    well as all time frames that the spans are aligned to. This assumes that the
+    fastpunct output was already added to the segments, if not then fastpunct will
+    be run on each segment individually. Segments that were not aligned yet are
+    aligned here. New identifiers are taken from the
+    Identifiers instance of the request.
+
+    With defer set the spans, frames and alignments of the segments are not
+    created, their identifiers are reserved and a list with what is needed to
+    create them later is returned, see iter_annotations()."""
+    new_document, new_timeframe = add_toplevel_annotations(new_view, identifiers)
     # Loop through the segments and add spans, frames and alignments, this is
     # also where we collect the specifics for the top level document and frame.
     text = []
     doc_start = sys.maxsize
     doc_end = -1
     doc_offset = 0
+    deferred = []
     for segment in segments:
         if PRINT_PROGRESS:
             print('SEGMENT:', segment)
-        text_out = segment.run_fastpunct()
-        aligned_segment = align_new_text(segment, text_out)
-        for aligned in aligned_segment:
-            (i, word_in_aligned, word_out_aligned,
-             j, word_in, token, timeframe) = aligned
-            if word_out_aligned is None:
+        words, positions = segment.align()
+        offsets = []
+        for word in words:
+            offsets.append(doc_offset)
+            doc_offset += len(word) + 1
+        if words:
+            text.extend(words)
+            doc_start = min(doc_start, segment.tokens.starts[positions].min().item())
+            doc_end = max(doc_end, segment.tokens.ends[positions].max().item())
+            if defer:
+                first_ids = reserve_identifiers(identifiers, len(words))
+                deferred.append((first_ids, words, segment.tokens, positions, offsets))
                 continue
-            text.append(word_out_aligned)
-            doc_start = min(doc_start, timeframe.properties['start'])
-            doc_end = max(doc_end, timeframe.properties['end'])
-            p1 = doc_offset
-            p2 = doc_offset + len(word_out_aligned)
-            add_annotations(new_view, word_out_aligned, timeframe, p1, p2)
-            doc_offset += len(word_out_aligned) + 1
+            with METRICS.timer('add_annotations'):
+                add_annotations(new_view, identifiers, words, segment.tokens, positions, offsets)
     update_toplevel_annotations(new_document, new_timeframe,
                                 text, doc_start, doc_end)
+    return deferred
 
 
 def align_new_text(segment, text_out):
     """Align the text with restored punctuation and capitalization with the
-    tokens and timeframes in the segment."""
+    tokens and timeframes in the segment. Returns the words that go into the
+    output and for each word the position in the token arrays of the input word
+    it is aligned with. Words that fastpunct added are aligned with the input
+    word before them, or with the first input word if there is none."""
     words_in = segment.words()
     words_out = text_out.split()
-    words_in_aligned, words_out_aligned = align(words_in, words_out)
-    # TODO: maybe the following needs to be moved elsewhere
-    # TODO: conceptually that aligned list is somewhat unintuitive
-    aligned_zipped = list(zip(words_in_aligned, words_out_aligned))
-    fix_errors(aligned_zipped)
-    aligned = []
-    adjustment = 0
-    for i, (word_in_aligned, word_out_aligned) in enumerate(aligned_zipped):
-        if word_in_aligned is None:
-            adjustment += 1
-        # make sure j points to a legal index in the original data
-        j = max(0, i - adjustment)
-        j = min(j, len(segment.tokens) - 1)
-        aligned.append((i, word_in_aligned, word_out_aligned,
-                        j, words_in[j], segment.tokens[j], segment.timeframes[j]))
-    #print_alignments(aligned)
-    return aligned
-
-
-def get_segments(view):
-    """Return a list of Segments from the view. Segments are slices of the text
+    with METRICS.timer('align'):
+        indexes_in, indexes_out = align_indexes(words_in, words_out, band=ALIGNMENT_BAND)
+    words, indexes_in = fix_errors(words_in, words_out, indexes_in, indexes_out)
+    # Input indexes only go up, so a running maximum gives the index of the
+    # last input word at each position.
+    first = segment.first
+    return words, [first + max(0, i) for i in itertools.accumulate(indexes_in, max)]
+
+
+def get_segments(tokens):
+    """Return a list of Segments from the tokens. Segments are slices of the text
     that are separated by a pause (where MAX_PAUSE determines the maximum pause
-    between words in the same segment). Each segment has a token and its aligned
-    timeframe."""
-    tokens, timeframes = get_annotations(view)
+    between words in the same segment) and that have at most MAX_SEGMENT_SIZE
+    tokens. Each segment has a range of tokens and their aligned timeframes. If
+    SEGMENTATION is set to 'budget' then this hands off to get_budget_segments().
+
+    Boundaries are computed on the arrays of the tokens: a run of tokens without
+    long pauses is cut every MAX_SEGMENT_SIZE tokens, which is what we get when
+    we go through the tokens one by one and start a new segment at each long
+    pause and each time a segment is full."""
+    if SEGMENTATION == 'budget':
+        return get_budget_segments(tokens, SubwordCounter(get_tokenizer()))
+    n = len(tokens)
+    if n == 0:
+        return []
+    # Runs of tokens between long pauses, the very first start is always
+    # considered to be after a pause.
+    run_firsts = np.flatnonzero(get_pauses(tokens) > MAX_PAUSE)
+    run_lasts = np.append(run_firsts[1:], n)
+    pieces = -(-(run_lasts - run_firsts) // MAX_SEGMENT_SIZE)
+    # Index of each piece within its run.
+    offsets = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    firsts = np.repeat(run_firsts, pieces) + offsets * MAX_SEGMENT_SIZE
+    lasts = np.minimum(firsts + MAX_SEGMENT_SIZE, np.repeat(run_lasts, pieces))
+    return [Segment(tokens, first, last) for first, last in zip(firsts.tolist(), lasts.tolist())]
+
+
+def get_pauses(tokens):
+    """Return an array where element i is the pause between token i-1 and token
+    i. The first element is larger than any pause so that the first token always
+    starts a segment."""
+    pauses = np.empty(len(tokens))
+    if len(tokens):
+        pauses[0] = np.inf
+        pauses[1:] = tokens.starts[1:] - tokens.ends[:-1]
+    return pauses
+
+
+def longest_pause(pauses, first, last):
+    """Return the position in range(first, last) with the longest pause, taking
+    the last one if there is a tie."""
+    reversed_pauses = pauses[first:last][::-1]
+    return last - 1 - int(np.argmax(reversed_pauses))
+
+
+def get_budget_segments(tokens, counter, budget=None, min_fill=None):
+    """Return a list of Segments where each segment has at most budget subword
+    tokens as counted by the SubwordCounter. From the start of a segment we find
+    how far the segment can extend and then cut at the longest pause among the
+    positions where the segment has at least min_fill times the budget, taking
+    the last one if there is a tie. Each segment is then measured with the
+    tokenizer on the full text and cut in two at its longest pause if it does not
+    fit after all."""
+    budget = SUBWORD_BUDGET if budget is None else budget
+    min_fill = MIN_FILL if min_fill is None else min_fill
+    n = len(tokens)
+    # costs[i] is the number of subword tokens for the first i words.
+    costs = np.empty(n + 1, dtype=np.int64)
+    costs[0] = counter.fixed
+    costs[1:] = [counter.count(word) for word in tokens.words]
+    costs = np.cumsum(costs)
+    pauses = get_pauses(tokens)
     segments = []
-    segment = Segment()
-    # the very first start is always considered to be after a pause
-    previous_end = -MAX_PAUSE - 1
-    for token, timeframe in zip(tokens, timeframes):
-        t_props = token.properties
-        tf_props = timeframe.properties
-        start = timeframe.properties['start']
-        end = timeframe.properties['end']
-        length = end - start
-        pause = start - previous_end
-        #print_token_and_timeframe(token, timeframe, pause)
-        if start - previous_end > MAX_PAUSE or len(segment) >= MAX_SEGMENT_SIZE:
-            if segment:
-                segments.append(segment)
-            segment = Segment()
-        segment.append_token_and_timeframe(token, timeframe)
-        previous_end = end
-    if segment:
-        segments.append(segment)
+    first = 0
+    while first < n:
+        # The segment can extend to the last position where it still fits, but
+        # always has at least one token.
+        limit = int(np.searchsorted(costs, costs[first] + budget - counter.fixed, 'right')) - 1
+        last = max(first + 1, min(limit, n))
+        if last < n:
+            fill = int(np.searchsorted(costs, costs[first] + min_fill * (budget - counter.fixed)))
+            lowest = max(first + 1, fill)
+            if lowest <= last:
+                last = longest_pause(pauses, lowest, last + 1)
+        segments.extend(split_segment(Segment(tokens, first, last), pauses, counter, budget))
+        first = last
     return segments
 
 
+def split_segment(segment, pauses, counter, budget):
+    """Return a list with the segment if it fits in the budget according to the
+    tokenizer, otherwise cut it at its longest pause and split both halves."""
+    if len(segment) == 1 or counter.measure(segment.text()) <= budget:
+        return [segment]
+    cut = longest_pause(pauses, segment.first + 1, segment.last)
+    return (split_segment(Segment(segment.tokens, segment.first, cut), pauses, counter, budget)
+            + split_segment(Segment(segment.tokens, cut, segment.last), pauses, counter, budget))
+
+
+def get_tokenizer():
+    """Return the tokenizer of the fastpunct model. This is taken from the model
+    unless inference runs on the replica pool, in which case only the tokenizer
+    is loaded in this process."""
+    global TOKENIZER
+    if TOKENIZER is None:
+        if POOL is None:
+            TOKENIZER = MODEL.get().tokenizer
+        else:
+            POOL.get()
+            TOKENIZER = model.load_tokenizer()
+    return TOKENIZER
+
+
 def get_annotations(view):
     """Get all tokens and corresponding time frames from the view. The tokens in the
     view are assumed to be in order and the timeframes line up with the tokens."""
@@ -228,40 +681,82 @@ def get_annotations(view):
             timeframes_idx[annotation.id] = annotation
         elif annotation.at_type.shortname == alignment_attype_shortname:
             alignments_idx[annotation.properties['target']] = annotation
-    timeframes = []
+    arrays = Tokens()
     for token in tokens:
         alignment = alignments_idx[token.id]
         timeframe = timeframes_idx[alignment.properties['source']]
         #print(token.id, alignment.properties, timeframe.properties)
-        timeframes.append(timeframe)
-    return tokens, timeframes
+        arrays.append(token.properties['word'], timeframe.properties['start'],
+                      timeframe.properties['end'], timeframe.properties['frameType'],
+                      token.id, timeframe.id)
+    return arrays.finish()
+
+
+def get_annotations_from_json(view_json):
+    """Does the same as get_annotations(), but takes the view as a dictionary from
+    the JSON input. This takes one pass over the annotations to collect tokens,
+    timeframes and alignments, and the tokens are only linked to timeframes after
+    that pass, so the order of annotations in the view does not matter."""
+    tokens = []
+    timeframes_idx = {}
+    alignments_idx = {}
+    # Maps @type values to what kind of annotation they are, so we do not have to
+    # split the type URL for each annotation.
+    kinds = {}
+    for annotation in view_json['annotations']:
+        at_type = annotation['@type']
+        kind = kinds.get(at_type)
+        if kind is None:
+            kind = kinds[at_type] = at_type.rsplit('/', 1)[-1]
+        props = annotation['properties']
+        if kind == 'Token':
+            tokens.append(props)
+        elif kind == 'TimeFrame':
+            timeframes_idx[props['id']] = props
+        elif kind == 'Alignment':
+            alignments_idx[props['target']] = props['source']
+    arrays = Tokens()
+    for token in tokens:
+        timeframe = timeframes_idx[alignments_idx[token['id']]]
+        arrays.append(token['word'], timeframe['start'], timeframe['end'],
+                      timeframe['frameType'], token['id'], timeframe['id'])
+    return arrays.finish()
 
 
-def add_toplevel_annotations(new_view):
+def add_toplevel_annotations(new_view, identifiers):
     """Create the annotations for the top-level elements: a text document and a
     time frame for the entire document, some specifics (text of the document,
     start and end of the frame) will be filled in later and therefore this
     function returns the new document and time frame."""
-    new_document = new_view.new_textdocument(DocumentTypes.TextDocument, 'en', Identifiers.new("td"))
-    new_timeframe = new_view.new_annotation(AnnotationTypes.TimeFrame, Identifiers.new("tf"))
+    new_document = new_view.new_textdocument(DocumentTypes.TextDocument, 'en', identifiers.new("td"))
+    new_timeframe = new_view.new_annotation(AnnotationTypes.TimeFrame, identifiers.new("tf"))
     # Also add the alignment between the document and timeframe
     new_view.new_annotation(AnnotationTypes.Alignment,
-                            Identifiers.new("a"),
+                            identifiers.new("a"),
                             source=new_timeframe.id,
                             target=new_document.id)
     return new_document, new_timeframe
 
 
-def fix_errors(aligned_zipped):
-    """Fix some common errors in the output of fastpunct."""
-    fix_local_alignment_errors(aligned_zipped)
-    fix_none_sequences(aligned_zipped)
+def fix_errors(words_in, words_out, indexes_in, indexes_out):
+    """Fix some common errors in the output of fastpunct. Takes the input and
+    output words and the aligned indexes as returned by align_indexes(), and
+    returns the output words after fixing and the input index for each of
+    them."""
+    with METRICS.timer('fix_errors'):
+        words = fix_local_alignment_errors(words_in, words_out, indexes_in, indexes_out)
+        return fix_none_sequences(words, indexes_in)
 
 
-def fix_local_alignment_errors(aligned_zipped):
+def fix_local_alignment_errors(words_in, words_out, indexes_in, indexes_out):
     """Fix local transformations like 'tragic ==> Tragicity'. Also tentatively
-    copies input word to the output if there is nothing aligned."""
-    for i, (word_in, word_out) in enumerate(aligned_zipped):
+    copies input word to the output if there is nothing aligned. Returns a list
+    with an output word for each position in the alignment."""
+    words = []
+    fixes = 0
+    for i, j in zip(indexes_in, indexes_out):
+        word_in = words_in[i] if i != GAP else None
+        word_out = words_out[j] if j != GAP else None
         # If word_in does not align with anything then copy it to word_out.
         # TODO: this may need a context check.
         fixed_word_out = None
@@ -269,62 +764,122 @@ def fix_local_alignment_errors(aligned_zipped):
             fixed_word_out = word_in
         # Tries to replace things like 'gbh ==> BBC' with 'gbh ==> GBH'.
         # TODO: this needs work
-        elif word_in is not None and word_out is not None and \
+        elif word_in is not None and \
              word_out.isupper() and len(word_in) == len(word_out) \
              and word_in != word_out.lower():
             fixed_word_out = word_in.upper()
         # If a token that is just letters is changed then revert to the
         # original. This will turn the alignment (robert, Laurent) back to
         # (robert, robert). May want to keep capitalization though.
-        elif word_in is not None and word_out is not None \
+        elif word_in is not None \
              and word_in.lower() != word_out.lower() and word_out.isalpha():
             fixed_word_out = word_in
         if fixed_word_out is not None:
             if PRINT_ERROR_FIXES:
                 print("ERROR_FIX: [%s] ==> [%s]" % (word_out, word_in))
-            aligned_zipped[i] = (word_in, fixed_word_out)
-
-
-def fix_none_sequences(aligned_zipped):
-    """Sometimes there are long sequences of None on the input side mapped to
-    words on the output side. Typically these sequences repeat text from the
-    input and they can be cut out."""
-    none_sequences = []
-    none_sequence = []
-    for i, (word_in, word_out) in enumerate(aligned_zipped):
-        if word_in is None and word_out is not None:
-            none_sequence.append(i)
-        elif word_in is not None and none_sequence:
-            none_sequences.append(none_sequence)
-            none_sequence = []
-    if none_sequence:
-        none_sequences.append(none_sequence)
-    # Cut out all none sequences as long as they are longer than 1
-    for seq in reversed(none_sequences):
-        if PRINT_ERROR_FIXES:
-            print("ERROR_FIX: deleting tokens %s through %s" % (seq[0], seq[-1]))
-        if len(seq) > 1:
-            aligned_zipped[seq[0]:seq[-1]+1] = []
-
-
-def add_annotations(view, word, timeframe, p1, p2):
-    """Add Span, TimeFrame and Alignment annotations to the view. We do not need to
-    add document properties to the Span and TimeFrame because this was done by the
-    metadata."""
-    # Creating a Span for the new potentially punctuated word
-    new_span = view.new_annotation(AnnotationTypes.Span, Identifiers.new("s"))
-    new_span.add_property('text', word)
-    new_span.add_property('start', p1)
-    new_span.add_property('end', p2)
-    # Creating a new TimeFrame from the TimeFrame in the source view.
-    new_frame = view.new_annotation(AnnotationTypes.TimeFrame, Identifiers.new("tf"))
-    new_frame.add_property('start', timeframe.properties['start'])
-    new_frame.add_property('end', timeframe.properties['end'])
-    new_frame.add_property('frameType', timeframe.properties['frameType'])
-    # Creating an Alignment, using the identifiers of the newly created span and frame.
-    new_alignment = view.new_annotation(AnnotationTypes.Alignment, Identifiers.new("a"))
-    new_alignment.add_property('source', new_frame.id)
-    new_alignment.add_property('target', new_span.id)
+            word_out = fixed_word_out
+            fixes += 1
+        words.append(word_out)
+    if fixes:
+        METRICS.count('local_fixes', fixes)
+    return words
+
+
+def fix_none_sequences(words, indexes_in):
+    """Sometimes there are long sequences of output words that are not aligned
+    with input words. Typically these sequences repeat text from the input and
+    they can be cut out. Returns the words and the input indexes with all those
+    sequences that are longer than 1 removed."""
+    if GAP not in indexes_in:
+        return words, indexes_in
+    kept_words = []
+    kept_indexes = []
+    deletions = 0
+    # Start of the current sequence of gaps, or None if we are not in one.
+    start = None
+    for i, index_in in enumerate(indexes_in + [None]):
+        if index_in == GAP:
+            if start is None:
+                start = i
+            continue
+        if start is not None:
+            if PRINT_ERROR_FIXES:
+                print("ERROR_FIX: deleting tokens %s through %s" % (start, i - 1))
+            # Cut out all none sequences as long as they are longer than 1
+            if i - start > 1:
+                deletions += i - start
+            else:
+                kept_words.append(words[start])
+                kept_indexes.append(GAP)
+            start = None
+        if index_in is not None:
+            kept_words.append(words[i])
+            kept_indexes.append(index_in)
+    if deletions:
+        METRICS.count('none_sequence_deletions', deletions)
+    return kept_words, kept_indexes
+
+
+def add_annotations(view, identifiers, words, tokens, positions, offsets):
+    """Add Span, TimeFrame and Alignment annotations to the view for each word,
+    where positions has the index of the token in tokens that the word is aligned
+    with and offsets has the character offset of the word in the new document.
+    The TimeFrame is copied from the TimeFrame of the token in the source view. We
+    do not need to add document properties to the Span and TimeFrame because this
+    was done by the metadata.
+
+    Annotations are added as JsonAnnotations, which are a lot cheaper to create
+    than mmif-python annotations and which serialize to the same JSON. The
+    identifiers for all annotations are reserved up front."""
+    first_ids = reserve_identifiers(identifiers, len(words))
+    append = view.annotations.append
+    for annotation in create_annotations(first_ids, words, tokens, positions, offsets):
+        append(annotation)
+
+
+def reserve_identifiers(identifiers, n):
+    """Reserve identifiers for the spans, timeframes and alignments of n words and
+    return the numbers of the first ones."""
+    return identifiers.reserve("s", n), identifiers.reserve("tf", n), identifiers.reserve("a", n)
+
+
+def create_annotations(first_ids, words, tokens, positions, offsets):
+    """Return the annotations that add_annotations() adds as a list, using the
+    identifiers reserved by reserve_identifiers()."""
+    span_type = str(AnnotationTypes.Span)
+    timeframe_type = str(AnnotationTypes.TimeFrame)
+    alignment_type = str(AnnotationTypes.Alignment)
+    first_span, first_frame, first_alignment = first_ids
+    # Plain Python numbers, numpy numbers do not serialize to JSON.
+    starts = tokens.starts[positions].tolist()
+    ends = tokens.ends[positions].tolist()
+    annotations = []
+    append = annotations.append
+    for i in range(len(words)):
+        word = words[i]
+        k = positions[i]
+        span_id = "s%d" % (first_span + i)
+        frame_id = "tf%d" % (first_frame + i)
+        # Creating a Span for the new potentially punctuated word
+        append(JsonAnnotation(span_type, {
+            'text': word, 'start': offsets[i], 'end': offsets[i] + len(word), 'id': span_id}))
+        # Creating a new TimeFrame from the TimeFrame in the source view.
+        append(JsonAnnotation(timeframe_type, {
+            'start': starts[i], 'end': ends[i],
+            'frameType': tokens.frame_types[k], 'id': frame_id}))
+        # Creating an Alignment, using the identifiers of the new span and frame.
+        append(JsonAnnotation(alignment_type, {
+            'source': frame_id, 'target': span_id, 'id': "a%d" % (first_alignment + i)}))
+    return annotations
+
+
+def iter_annotations(deferred):
+    """Generate the annotations for each of the deferred segments that
+    run_fastpunct() returns."""
+    for arguments in deferred:
+        with METRICS.timer('add_annotations'):
+            annotations = create_annotations(*arguments)
+        yield annotations
 
 
 def update_toplevel_annotations(
@@ -348,84 +903,268 @@ def print_segments(segments):
         print(segment)
 
 
-def print_alignments(alignments, start=None, end=None):
-    """Debugging method to print a list of alignments."""
-    if start is None and end is None:
-        start = 0
-        end = len(alignments)
-    for i in range(start, end):
-        print_alignment(alignments[i])
+def print_alignments(words, positions, tokens):
+    """Debugging method to print output words with the tokens they are aligned
+    with, takes what align_new_text() returns."""
+    for word, k in zip(words, positions):
+        timespan = "%s:%s" % (tokens.starts[k], tokens.ends[k])
+        print("%-8s %-12s %-15s  %-12s"
+              % (tokens.token_ids[k], tokens.words[k], timespan, word))
     print()
 
 
-def print_alignment(aligned):
-    """Debugging method to print an alignment."""
-    (i, word_in_aligned, word_out_aligned, j, word_in, token, timeframe) = aligned
-    timespan = "%s:%s" % (timeframe.properties['start'], timeframe.properties['end'])
-    charspan = "%s:%s" % (token.properties['start'], token.properties['end'])
-    print("%2d  %-12s %-12s %-15s  %2d  %-12s %-12s"
-          % (j, word_in, charspan, timespan,
-             i, word_in_aligned, word_out_aligned))
+def print_token_and_timeframe(tokens, i, pause):
+    print("%-8s %-8s  %6d %6d %4d %s"
+          % (tokens.token_ids[i], tokens.timeframe_ids[i],
+             tokens.starts[i], tokens.ends[i], pause, tokens.words[i]))
 
 
-def print_token_and_timeframe(token, timeframe, pause):
-    t_props = token.properties
-    tf_props = timeframe.properties
-    print("%4d %4d  %6d %6d %4d %s"
-          % (t_props['start'], t_props['end'],
-             tf_props['start'], tf_props['end'], pause, t_props['word']))
+class Tokens(object):
 
+    """The tokens from a Kaldi view, with for each token the word, the start and
+    end of its timeframe, the frame type of the timeframe, and the identifiers of
+    the token and timeframe in the Kaldi view. Tokens are added with append() and
+    when all tokens are in finish() turns the starts and ends into numpy arrays,
+    which is what segmentation works on. Segments are ranges of indexes into
+    these arrays and lists."""
 
-class Segment(object):
+    __slots__ = ('words', 'starts', 'ends', 'frame_types', 'token_ids', 'timeframe_ids')
 
     def __init__(self):
-        self.tokens = []
-        self.timeframes = []
+        self.words = []
+        self.starts = []
+        self.ends = []
+        self.frame_types = []
+        self.token_ids = []
+        self.timeframe_ids = []
+
+    def __len__(self):
+        return len(self.words)
+
+    def append(self, word, start, end, frame_type, token_id, timeframe_id):
+        self.words.append(word)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.frame_types.append(frame_type)
+        self.token_ids.append(token_id)
+        self.timeframe_ids.append(timeframe_id)
+
+    def finish(self):
+        self.starts = np.array(self.starts)
+        self.ends = np.array(self.ends)
+        return self
+
+    def fingerprint(self):
+        """Return a hash of the words and timeframes. Identifiers are left out so
+        that the fingerprint only changes when the content changes."""
+        content = json.dumps([self.words, self.starts.tolist(), self.ends.tolist(),
+                              self.frame_types])
+        return hashlib.sha256(content.encode('utf8')).hexdigest()
+
+
+class SubwordCounter(object):
+
+    """Counts subword tokens of the input to fastpunct. Counts for words are
+    cached, and the count for a text is the sum of the counts of its words plus
+    the count for the prefix and the end-of-sequence token, which is what the
+    sentencepiece tokenizer of fastpunct gives since its pieces do not cross
+    spaces. The measure() method runs the tokenizer on the full text."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.counts = {}
+        self.fixed = len(tokenizer(inference.PREFIX.strip()).input_ids)
+
+    def count(self, word):
+        count = self.counts.get(word)
+        if count is None:
+            count = self.counts[word] = len(self.tokenizer.tokenize(word))
+        return count
+
+    def measure(self, text):
+        return len(self.tokenizer(inference.PREFIX + text).input_ids)
+
+
+class Segment(object):
+
+    """A range of tokens, from index first up to but not including index last."""
+
+    __slots__ = ('tokens', 'first', 'last', 'text_out', 'alignment')
+
+    def __init__(self, tokens, first, last=None):
+        self.tokens = tokens
+        self.first = first
+        self.last = first if last is None else last
+        self.text_out = None
+        self.alignment = None
 
     def __str__(self):
-        return "<Segment tokens=%d timeframes=%d '%s:%s --> %s:%s'>" \
-            % (len(self.tokens), len(self.timeframes),
-               self.tokens[0].properties['word'],
-               self.timeframes[0].properties['start'],
-               self.tokens[-1].properties['word'],
-               self.timeframes[-1].properties['end'])
+        return "<Segment tokens=%d '%s:%s --> %s:%s'>" \
+            % (len(self),
+               self.tokens.words[self.first],
+               self.tokens.starts[self.first],
+               self.tokens.words[self.last - 1],
+               self.tokens.ends[self.last - 1])
 
     def __len__(self):
-        return len(self.tokens)
-
-    def append_token_and_timeframe(self, token, timeframe):
-        self.tokens.append(token)
-        self.timeframes.append(timeframe)
+        return self.last - self.first
 
     def words(self):
-        return [t.properties['word'] for t in self.tokens]
+        return self.tokens.words[self.first:self.last]
 
     def text(self):
         return ' '.join(self.words())
 
     def run_fastpunct(self):
+        return self.set_text_out(punct_texts([self.text()])[0])
+
+    def align(self):
+        """Align the fastpunct output with the tokens of the segment, running
+        fastpunct first if needed. Returns the words and positions that
+        align_new_text() returns, which are kept on the segment."""
+        if self.alignment is None:
+            text_out = self.text_out
+            if text_out is None:
+                text_out = self.run_fastpunct()
+            self.alignment = align_new_text(self, text_out)
+        return self.alignment
+
+    def set_text_out(self, text_out):
+        """Store the output of fastpunct on this segment, after checking whether
+        it is acceptable, and return what was stored."""
+        self.alignment = None
         text_in = self.text()
-        text_out = FASTPUNCT.punct(text_in)
-        ratio = len(text_in) / len(text_out)
+        # Inference returns an empty string when it stopped decoding because the
+        # output ran away, which it only does when the check below would have
+        # thrown the output away. An empty output is treated as infinitely long.
+        ratio = len(text_in) / len(text_out) if text_out else 0.0
         if False:
             print('>>> %4d  %.2f  %s' % (len(text_in), ratio, text_out[:80]))
         # Undo all processing when we run into the nasty case where fastpunct
         # flips out on longer input with repetitions.
-        if ratio < 0.95 and len(text_in.split()) > 10:
+        if ratio < inference.FALLBACK_RATIO and len(text_in.split()) > inference.FALLBACK_MIN_WORDS:
             text_out = text_in
+            METRICS.count('ratio_fallbacks')
+        self.text_out = text_out
         return text_out
 
 
 if __name__ == "__main__":
 
-    app = App()
-    service = Restifier(app)
-
     parser = argparse.ArgumentParser()
     parser.add_argument('--develop',  action='store_true')
+    parser.add_argument('--model-wait', type=float, default=server.MODEL_WAIT,
+                        help="seconds an annotation request waits for the model to load")
+    parser.add_argument('--warmup-runs', type=int, default=model.WARMUP_RUNS,
+                        help="number of warm-up inferences after loading the model")
+    parser.add_argument('--replicas', metavar='N',
+                        help="run N model replicas in separate processes, use 'auto' to "
+                             "pick N from the number of CPUs")
+    parser.add_argument('--replica-threads', type=int,
+                        help="number of torch threads for each replica")
+    parser.add_argument('--cache', metavar='FILE',
+                        help="SQLite file used as an on-disk cache of fastpunct output")
+    parser.add_argument('--cache-size', type=int, default=cache.DISK_SIZE // 1_000_000,
+                        help="maximum size of the on-disk cache in MB")
+    parser.add_argument('--engine', choices=list(engines.ENGINES), default=MODEL.engine,
+                        help="engine that runs the model, 'quantized' uses int8 weights")
+    parser.add_argument('--profile', choices=list(inference.PROFILES), default=PROFILE,
+                        help="decoding profile used when a request does not ask for one")
+    parser.add_argument('--segmentation', choices=['pause', 'budget'], default=SEGMENTATION,
+                        help="cut segments at pauses or fill them up to a subword budget")
+    parser.add_argument('--subword-budget', type=int, default=SUBWORD_BUDGET,
+                        help="maximum number of subword tokens in a segment with budget "
+                             "segmentation")
+    parser.add_argument('--jobs', metavar='FILE',
+                        help="SQLite file with the queue for asynchronous jobs, this enables "
+                             "the /jobs routes")
+    parser.add_argument('--job-runners', type=int, default=1,
+                        help="number of threads in each worker that run queued jobs")
+    parser.add_argument('--threads', type=int,
+                        help="serve with one gunicorn worker that handles this many "
+                             "requests at the same time, all sharing one model")
+    parser.add_argument('--batch-scheduler', action='store_true',
+                        help="run segments from concurrent requests in shared batches")
+    parser.add_argument('--batch-wait', type=float, default=scheduler.MAX_WAIT,
+                        help="seconds the batch scheduler waits for a batch to fill up")
+    parser.add_argument('--batch-tokens', type=int, default=scheduler.TOKEN_BUDGET,
+                        help="maximum number of subword tokens in a batch of the batch "
+                             "scheduler, counting padding (default: no limit)")
+    parser.add_argument('--pipeline-batches', type=int, default=PIPELINE_BATCHES,
+                        help="number of batches that go through fastpunct before their "
+                             "segments are aligned, 0 runs all inference first")
+    parser.add_argument('--no-stream', action='store_true',
+                        help="send annotation output in one piece instead of streaming it")
+    parser.add_argument('--no-compress', action='store_true',
+                        help="never compress responses, even if the client accepts that")
+    parser.add_argument('--preload', action='store_true',
+                        help="load the model before the gunicorn workers are forked, so "
+                             "that all workers share one copy of the weights")
+    parser.add_argument('--inference-concurrency', type=int,
+                        help="maximum number of requests in a worker that run inference "
+                             "at the same time (default: no limit)")
     args = parser.parse_args()
+    if args.preload and args.replicas:
+        parser.error("--preload cannot be used with --replicas")
+    if args.batch_scheduler and (args.replicas or args.inference_concurrency):
+        parser.error("--batch-scheduler cannot be used with --replicas or "
+                     "--inference-concurrency")
+
+    # The default profile goes into the metadata, so it has to be set before
+    # the application is created.
+    PROFILE = args.profile
+    app = App()
+    service = Restifier(app)
+
+    MODEL.warmup_runs = args.warmup_runs
+    MODEL.engine = args.engine
+    SEGMENTATION = args.segmentation
+    SUBWORD_BUDGET = args.subword_budget
+    PIPELINE_BATCHES = args.pipeline_batches
+    set_inference_concurrency(args.inference_concurrency)
+    if args.batch_scheduler:
+        SCHEDULER = scheduler.BatchScheduler(
+            MODEL, max_wait=args.batch_wait, token_budget=args.batch_tokens,
+            batch_size=BATCH_SIZE)
+    if args.cache:
+        CACHE.open(args.cache, disk_size=args.cache_size * 1_000_000)
+    loader = MODEL
+    options = {}
+    if args.threads:
+        # Requests are annotated on threads of one worker, which saves loading
+        # the model in each of many workers.
+        options = {'workers': 1, 'threads': args.threads}
+    if args.replicas:
+        replicas = None if args.replicas == 'auto' else int(args.replicas)
+        POOL = pool.ReplicaPool(replicas, args.replica_threads, engine=args.engine)
+        loader = POOL
+        # The replicas do the heavy lifting, so we use just one gunicorn worker
+        # with enough threads to keep all replicas busy.
+        options = {'workers': 1, 'threads': args.threads or max(2, POOL.replicas)}
+    job_queue = jobs.JobQueue(args.jobs) if args.jobs else None
+    runners = [jobs.JobRunner(job_queue, app, loader) for _ in range(args.job_runners)] \
+        if job_queue else []
+    server.add_routes(service.flask_app, app, loader, model_wait=args.model_wait,
+                      cache=CACHE, jobs=job_queue, stream=not args.no_stream,
+                      compress=not args.no_compress)
+
+    def start_worker(worker=None):
+        loader.start()
+        for runner in runners:
+            runner.start()
+        threading.Thread(target=model.report_memory, args=(loader,), daemon=True).start()
+
+    if args.preload:
+        # Workers are forked after this and share the pages with the weights for
+        # as long as nobody writes to them, which inference does not do.
+        if not MODEL.preload():
+            sys.exit("Could not load the model: %s" % MODEL.error)
+        model.report_memory(MODEL)
 
     if args.develop:
+        start_worker()
         service.run()
     else:
-        service.serve_production()
+        # Each gunicorn worker loads its own model, unless it was preloaded, and
+        # starts its own job runners once it is up.
+        service.serve_production(post_worker_init=start_worker, **options)
@@ -0,0 +1,257 @@
+"""batch.py
+
+Run the application on many MMIF files with one loaded model.
+
+$ python batch.py INDIR OUTDIR
+$ python batch.py --manifest FILES OUTDIR
+
+With two directories all files in INDIR that match the pattern (*.json by
+default) are processed and the output is written to a file with the same name in
+OUTDIR. With a manifest each line has an input file and optionally an output
+file separated by a tab, and when there is no output file the output goes to
+OUTDIR with the same name as the input. Relative output paths in the manifest
+are taken relative to OUTDIR.
+
+Input files that end in .gz or .zst are decompressed and output files that end
+in .gz or .zst are compressed, so with --pattern '*.json.gz' compressed inputs
+give compressed outputs.
+
+Outputs that already exist are skipped and outputs are written to a temporary
+file that is renamed when it is complete, so an interrupted run can simply be
+started again. Upcoming files are read and parsed on a background thread while
+the current file is processed, and output is written on another background
+thread. At the end the throughput is printed in tokens and in hours of audio per
+hour of wall-clock time.
+
+"""
+
+import os
+import sys
+import glob
+import time
+import queue
+import argparse
+import threading
+
+import app
+import cache
+import compression
+import engines
+import inference
+import mmifjson
+import pool
+
+
+# Number of parsed inputs kept ready on the reader thread, and number of outputs
+# that may wait for the writer thread.
+PREFETCH = 2
+WRITE_QUEUE = 4
+
+# Marks the end of the input on the reader and writer queues.
+DONE = None
+
+
+def get_files(indir, outdir, pattern='*.json', manifest=None):
+    """Return a list of pairs of input and output files."""
+    if manifest is None:
+        infiles = sorted(glob.glob(os.path.join(indir, pattern)))
+        return [(infile, os.path.join(outdir, os.path.basename(infile))) for infile in infiles]
+    files = []
+    with open(manifest) as fh:
+        for line in fh:
+            fields = line.rstrip('\n').split('\t')
+            if not fields[0].strip():
+                continue
+            infile = fields[0].strip()
+            outfile = fields[1].strip() if len(fields) > 1 and fields[1].strip() \
+                else os.path.basename(infile)
+            files.append((infile, os.path.join(outdir, outfile)))
+    return files
+
+
+def read_inputs(files, inputs):
+    """Read and parse the input files and put them on the inputs queue, with the
+    number of tokens and the duration of the audio in seconds. Inputs that cannot
+    be read are put on the queue with the exception instead of the JSON."""
+    for infile, outfile in files:
+        try:
+            mmif_json = mmifjson.load(compression.read_file(infile))
+            tokens, seconds = get_size(mmif_json)
+            inputs.put((infile, outfile, mmif_json, tokens, seconds))
+        except Exception as e:
+            inputs.put((infile, outfile, e, 0, 0))
+    inputs.put(DONE)
+
+
+def write_outputs(outputs, stats, lock):
+    """Write outputs from the outputs queue, each output is written to a temporary
+    file first which is then moved to its final name. A file only counts as
+    processed in the stats once it has its final name, outputs that cannot be
+    written count as failed and their temporary file is removed."""
+    while True:
+        item = outputs.get()
+        if item is DONE:
+            break
+        infile, outfile, mmif_string, tokens, seconds, started = item
+        tmpfile = outfile + '.tmp'
+        try:
+            encoding = compression.file_encoding(outfile)
+            with compression.open_file(tmpfile, 'wt', encoding) as fh:
+                fh.write(mmif_string)
+            os.replace(tmpfile, outfile)
+        except Exception as e:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            with lock:
+                stats['failed'] += 1
+            print("FAILED %s (%s: %s)" % (outfile, e.__class__.__name__, e), file=sys.stderr)
+            continue
+        with lock:
+            stats['processed'] += 1
+            stats['tokens'] += tokens
+            stats['seconds'] += seconds
+            done = stats['processed'] + stats['failed']
+        print("[%d/%d] %s  %d tokens  %.2fs"
+              % (done, stats['files'] - stats['skipped'], infile, tokens,
+                 time.time() - started))
+
+
+def get_size(mmif_json):
+    """Return the number of tokens and the duration of the audio in seconds over all
+    Kaldi views, where the duration is the end of the last time frame."""
+    tokens = 0
+    seconds = 0
+    for view in mmif_json.get('views', []):
+        if not view.get('metadata', {}).get('app', '').startswith(app.KALDI_APP):
+            continue
+        time_unit = 'milliseconds'
+        for at_type, properties in view['metadata'].get('contains', {}).items():
+            if at_type.endswith('/TimeFrame'):
+                time_unit = properties.get('timeUnit', time_unit)
+        divisor = 1000 if time_unit == 'milliseconds' else 1
+        end = 0
+        for annotation in view['annotations']:
+            kind = annotation['@type'].rsplit('/', 1)[-1]
+            if kind == 'Token':
+                tokens += 1
+            elif kind == 'TimeFrame':
+                end = max(end, annotation['properties'].get('end', 0))
+        seconds += end / divisor
+    return tokens, seconds
+
+
+def run(files, pretty=False, overwrite=False):
+    """Process all pairs of input and output files and return a dictionary with
+    counts and times."""
+    todo = [(i, o) for i, o in files if overwrite or not os.path.exists(o)]
+    stats = {'files': len(files), 'skipped': len(files) - len(todo), 'processed': 0,
+             'failed': 0, 'tokens': 0, 'seconds': 0, 'wall_time': 0}
+    print("Processing %d files, skipping %d that were already done"
+          % (len(todo), stats['skipped']))
+    if not todo:
+        return stats
+    loader = app.POOL if app.POOL is not None else app.MODEL
+    loader.get()
+    inputs = queue.Queue(PREFETCH)
+    outputs = queue.Queue(WRITE_QUEUE)
+    # The writer thread updates the stats too.
+    lock = threading.Lock()
+    reader = threading.Thread(target=read_inputs, args=(todo, inputs), daemon=True)
+    writer = threading.Thread(target=write_outputs, args=(outputs, stats, lock))
+    application = app.App()
+    t0 = time.time()
+    reader.start()
+    writer.start()
+    try:
+        while True:
+            item = inputs.get()
+            if item is DONE:
+                break
+            infile, outfile, mmif_json, tokens, seconds = item
+            t1 = time.time()
+            try:
+                if isinstance(mmif_json, Exception):
+                    raise mmif_json
+                os.makedirs(os.path.dirname(os.path.abspath(outfile)), exist_ok=True)
+                mmif_string = application.annotate(mmif_json, pretty=pretty)
+            except Exception as e:
+                with lock:
+                    stats['failed'] += 1
+                print("FAILED %s (%s: %s)" % (infile, e.__class__.__name__, e), file=sys.stderr)
+                continue
+            outputs.put((infile, outfile, mmif_string, tokens, seconds, t1))
+    finally:
+        outputs.put(DONE)
+        writer.join()
+        stats['wall_time'] = time.time() - t0
+    return stats
+
+
+def print_stats(stats):
+    hours = stats['wall_time'] / 3600
+    print("\nFiles processed:      %d" % stats['processed'])
+    print("Files skipped:        %d" % stats['skipped'])
+    print("Files failed:         %d" % stats['failed'])
+    print("Tokens:               %d" % stats['tokens'])
+    print("Audio hours:          %.2f" % (stats['seconds'] / 3600))
+    print("Wall-clock time:      %.1fs" % stats['wall_time'])
+    if hours > 0:
+        print("Tokens per hour:      %d" % (stats['tokens'] / hours))
+        print("Audio hours per hour: %.1f" % (stats['seconds'] / 3600 / hours))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('indir', nargs='?', help="directory with input files")
+    parser.add_argument('outdir', help="directory for output files")
+    parser.add_argument('--manifest', metavar='FILE',
+                        help="file with input and output files, use this instead of indir")
+    parser.add_argument('--pattern', default='*.json',
+                        help="pattern for input files in indir (default: *.json)")
+    parser.add_argument('--overwrite', action='store_true',
+                        help="process files even if their output exists")
+    parser.add_argument('--pretty', action='store_true', help="indent the output")
+    parser.add_argument('--replicas', metavar='N',
+                        help="run N model replicas in separate processes, use 'auto' to "
+                             "pick N from the number of CPUs")
+    parser.add_argument('--replica-threads', type=int,
+                        help="number of torch threads for each replica")
+    parser.add_argument('--cache', metavar='FILE',
+                        help="SQLite file used as an on-disk cache of fastpunct output")
+    parser.add_argument('--cache-size', type=int, default=cache.DISK_SIZE // 1_000_000,
+                        help="maximum size of the on-disk cache in MB")
+    parser.add_argument('--engine', choices=list(engines.ENGINES), default=app.MODEL.engine,
+                        help="engine that runs the model")
+    parser.add_argument('--profile', choices=list(inference.PROFILES),
+                        default=app.PROFILE, help="decoding profile")
+    parser.add_argument('--segmentation', choices=['pause', 'budget'], default=app.SEGMENTATION,
+                        help="cut segments at pauses or fill them up to a subword budget")
+    parser.add_argument('--subword-budget', type=int, default=app.SUBWORD_BUDGET,
+                        help="maximum number of subword tokens in a segment with budget "
+                             "segmentation")
+    parser.add_argument('--pipeline-batches', type=int, default=app.PIPELINE_BATCHES,
+                        help="number of batches that go through fastpunct before their "
+                             "segments are aligned, 0 runs all inference first")
+    args = parser.parse_args()
+
+    if (args.indir is None) == (args.manifest is None):
+        parser.error("give either an input directory or a manifest")
+    app.MODEL.engine = args.engine
+    app.PROFILE = args.profile
+    app.SEGMENTATION = args.segmentation
+    app.SUBWORD_BUDGET = args.subword_budget
+    app.PIPELINE_BATCHES = args.pipeline_batches
+    if args.cache:
+        app.CACHE.open(args.cache, disk_size=args.cache_size * 1_000_000)
+    if args.replicas:
+        replicas = None if args.replicas == 'auto' else int(args.replicas)
+        app.POOL = pool.ReplicaPool(replicas, args.replica_threads, engine=args.engine)
+    files = get_files(args.indir, args.outdir, args.pattern, args.manifest)
+    try:
+        stats = run(files, pretty=args.pretty, overwrite=args.overwrite)
+    except KeyboardInterrupt:
+        sys.exit("\nInterrupted, run the same command again to continue")
+    if stats['processed']:
+        print_stats(stats)
+    sys.exit(1 if stats['failed'] else 0)
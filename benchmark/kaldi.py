@@ -0,0 +1,115 @@
+"""kaldi.py
+
+Generate MMIF files that look like the output of the Kaldi wrapper.
+
+$ python -m benchmark.kaldi MINUTES OUTFILE
+
+This creates a MMIF file with one audio document and one Kaldi view with a text
+document and a Token, TimeFrame and Alignment for each word, in the same order
+and with the same kind of identifiers as data/example-input.json. Words are
+drawn from the vocabulary of that example with a roughly Zipfian distribution,
+word durations depend on the length of the word, and most gaps between words are
+short with the occasional longer pause, which is what decides where the
+application puts segment boundaries.
+
+"""
+
+import os
+import sys
+import json
+import random
+import itertools
+
+
+MMIF_VERSION = '0.4.0'
+VOCABULARY = 'http://mmif.clams.ai/%s/vocabulary' % MMIF_VERSION
+TOKEN_TYPE = 'http://vocab.lappsgrid.org/Token'
+KALDI_APP = 'http://apps.clams.ai/aapb-pua-kaldi-wrapper/0.2.2'
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'data', 'example-input.json')
+
+# Fraction of gaps between words that are pauses, and the mean length in
+# milliseconds of pauses and of the other gaps.
+PAUSE_RATE = 0.15
+PAUSE_MEAN = 600
+GAP_MEAN = 30
+
+# Milliseconds of speech per character of a word, and the minimum duration of
+# a word.
+MS_PER_CHAR = 60
+MIN_DURATION = 90
+
+
+def vocabulary():
+    """Return the words from the example input, most frequent first."""
+    with open(EXAMPLE) as fh:
+        mmif = json.load(fh)
+    counts = {}
+    for annotation in mmif['views'][0]['annotations']:
+        if annotation['@type'] == TOKEN_TYPE:
+            word = annotation['properties']['word']
+            counts[word] = counts.get(word, 0) + 1
+    return sorted(counts, key=lambda w: -counts[w])
+
+
+def generate(minutes, seed=0):
+    """Return a dictionary with a Kaldi-like MMIF document for the given number of
+    minutes of audio."""
+    rng = random.Random(seed)
+    words = vocabulary()
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    duration = int(minutes * 60 * 1000)
+    annotations = []
+    text = []
+    offset = 0
+    time = rng.randint(0, 2000)
+    n = 0
+    while True:
+        word = rng.choices(words, cum_weights=cum_weights)[0]
+        length = max(MIN_DURATION, int(rng.gauss(MS_PER_CHAR * len(word), 40)))
+        if time + length > duration:
+            break
+        n += 1
+        annotations.append(
+            {'@type': TOKEN_TYPE,
+             'properties': {'start': offset, 'end': offset + len(word),
+                            'document': 'v_0:td_1', 'word': word, 'id': 'to_%d' % n}})
+        annotations.append(
+            {'@type': VOCABULARY + '/TimeFrame',
+             'properties': {'start': time, 'end': time + length,
+                            'frameType': 'speech', 'id': 'tf_%d' % n}})
+        annotations.append(
+            {'@type': VOCABULARY + '/Alignment',
+             'properties': {'target': 'to_%d' % n, 'source': 'tf_%d' % n,
+                            'id': 'al_%d' % (n + 1)}})
+        text.append(word)
+        offset += len(word) + 1
+        mean = PAUSE_MEAN if rng.random() < PAUSE_RATE else GAP_MEAN
+        time += length + int(rng.expovariate(1 / mean))
+    header = [
+        {'@type': VOCABULARY + '/TextDocument',
+         'properties': {'text': {'@value': ' '.join(text), '@language': 'en'}, 'id': 'td_1'}},
+        {'@type': VOCABULARY + '/Alignment',
+         'properties': {'target': 'td_1', 'source': 'd1', 'id': 'al_1'}}]
+    contains = {
+        VOCABULARY + '/TextDocument': {},
+        TOKEN_TYPE: {},
+        VOCABULARY + '/TimeFrame': {'timeUnit': 'milliseconds', 'document': 'd1'},
+        VOCABULARY + '/Alignment': {}}
+    return {
+        'metadata': {'mmif': 'http://mmif.clams.ai/%s' % MMIF_VERSION},
+        'documents': [
+            {'@type': VOCABULARY + '/AudioDocument',
+             'properties': {'mime': 'audio', 'id': 'd1', 'location': 'file:///audio_in/synthetic.wav'}}],
+        'views': [
+            {'id': 'v_0',
+             'metadata': {'timestamp': '2021-09-09T13:56:23.603751', 'app': KALDI_APP,
+                          'contains': contains, 'parameters': {}},
+             'annotations': header + annotations}]}
+
+
+if __name__ == '__main__':
+
+    with open(sys.argv[2], 'w') as fh:
+        json.dump(generate(float(sys.argv[1])), fh)
@@ -0,0 +1,183 @@
+"""stages.py
+
+Time the stages of the application on synthetic Kaldi MMIF of several sizes.
+
+$ python -m benchmark.stages
+$ python -m benchmark.stages --sizes 1,10,60 --repeat 3 --out results.json
+
+Results are also written as JSON, by default to results.json in this directory,
+which is ignored by git.
+
+Sizes are in minutes of audio and default to 1 minute, 10 minutes, 1 hour and 5
+hours. For each size the following stages are timed separately:
+
+    parse              reading the JSON and building the skeleton Mmif object
+    mmif_objects       building the full Mmif object, which is what the
+                       application does when it gets a Mmif object as input
+    get_annotations    extracting tokens and timeframes from the Kaldi view
+    get_segments       cutting the tokens into segments
+    inference          running the stub over all segments and checking results
+    align              aligning the input words with the output words
+    fix_errors         fixing errors in the alignments
+    add_annotations    adding the annotations to the new view
+    serialize          serializing the output
+    total              the entire annotate() call on the JSON string
+
+Inference uses a deterministic stub instead of fastpunct so that this runs
+without the model and so that timings do not depend on what the model does. The
+stub capitalizes, adds punctuation and sometimes repeats part of the input, which
+is what fastpunct does when it goes off the rails, so that the alignment fixes
+and the length check have some work to do.
+
+Results are printed and written as JSON, with for each size the number of tokens
+and segments and the best time in seconds for each stage over all repeats.
+
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+
+from mmif.serialize import Mmif
+
+import app
+import mmifjson
+from align import align_indexes
+from benchmark import kaldi
+
+
+SIZES = [1, 10, 60, 300]
+
+# Default file for the results.
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.json')
+
+
+class StubPunctuator(object):
+
+    """Deterministic stand-in for fastpunct. It has the same interface as the
+    replica pool in the pool module so it can be installed as app.POOL."""
+
+    engine = 'stub'
+    replicas = 1
+
+    def punct(self, sentences, batch_size=None, progress=None, profile=None):
+        results = [self.punct_sentence(sentence) for sentence in sentences]
+        if progress is not None:
+            progress(len(sentences))
+        return results
+
+    @staticmethod
+    def punct_sentence(sentence):
+        words = sentence.split()
+        out = []
+        for i, word in enumerate(words):
+            if i == 0:
+                word = word.capitalize()
+            if i % 7 == 6:
+                word += ','
+            out.append(word)
+        # Repeat some of the input for one in every 23 longer sentences.
+        if len(words) > 20 and len(sentence) % 23 == 0:
+            out.extend(words[:len(words) // 2])
+        return ' '.join(out) + '.'
+
+
+def clear_cache():
+    # Otherwise only the first inference stage would run the stub.
+    app.CACHE.memory.clear()
+    app.CACHE.memory_used = 0
+
+
+def timed(function, *args):
+    t0 = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - t0, result
+
+
+def time_stages(mmif_string):
+    """Run all stages once on the MMIF string and return a dictionary with the
+    number of tokens and segments and the time for each stage."""
+    clams_app = app.App()
+    clear_cache()
+    times = {}
+    times['parse'], (mmif_json, mmif_obj) = timed(
+        lambda: (lambda j: (j, Mmif(mmifjson.skeleton(j))))(mmifjson.load(mmif_string)))
+    times['mmif_objects'], _ = timed(Mmif, mmif_string)
+    view_json = mmif_json['views'][0]
+    times['get_annotations'], tokens = timed(app.get_annotations_from_json, view_json)
+    times['get_segments'], segments = timed(app.get_segments, tokens)
+    times['inference'], _ = timed(app.punct_segments, segments)
+    words = [(segment.words(), segment.text_out.split()) for segment in segments]
+    times['align'], alignments = timed(
+        lambda: [align_indexes(w_in, w_out, band=app.ALIGNMENT_BAND) for w_in, w_out in words])
+    times['fix_errors'], _ = timed(
+        lambda: [app.fix_errors(w_in, w_out, *alignment)
+                 for (w_in, w_out), alignment in zip(words, alignments)])
+    # Collect what add_annotations() needs from the aligned segments, this is
+    # not timed.
+    identifiers = app.Identifiers()
+    new_view = clams_app._new_view(mmif_obj, mmif_obj.views[view_json['id']])
+    app.add_toplevel_annotations(new_view, identifiers)
+    arguments = []
+    offset = 0
+    for segment in segments:
+        aligned_words, positions = app.align_new_text(segment, segment.text_out)
+        offsets = []
+        for word in aligned_words:
+            offsets.append(offset)
+            offset += len(word) + 1
+        arguments.append((aligned_words, segment.tokens, positions, offsets))
+    times['add_annotations'], _ = timed(
+        lambda: [app.add_annotations(new_view, identifiers, *args)
+                 for args in arguments if args[0]])
+    times['serialize'], _ = timed(mmifjson.serialize, mmif_obj, mmif_json)
+    clear_cache()
+    times['total'], _ = timed(clams_app.annotate, mmif_string)
+    return {'tokens': len(tokens), 'segments': len(segments), 'stages': times}
+
+
+def run(sizes, repeat=1):
+    app.POOL = StubPunctuator()
+    results = []
+    for minutes in sizes:
+        mmif_string = json.dumps(kaldi.generate(minutes))
+        runs = [time_stages(mmif_string) for _ in range(repeat)]
+        result = {'minutes': minutes, 'bytes': len(mmif_string),
+                  'tokens': runs[0]['tokens'], 'segments': runs[0]['segments'],
+                  'stages': {stage: min(r['stages'][stage] for r in runs)
+                             for stage in runs[0]['stages']}}
+        print_result(result)
+        results.append(result)
+    return results
+
+
+def print_result(result):
+    print("%5s minutes  %7d tokens  %6d segments"
+          % (result['minutes'], result['tokens'], result['segments']))
+    for stage, seconds in result['stages'].items():
+        print("    %-18s %9.4f" % (stage, seconds))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=','.join(str(s) for s in SIZES),
+                        help="comma-separated list of audio lengths in minutes")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="number of runs per size, the best time is reported")
+    parser.add_argument('--out', default=RESULTS,
+                        help="file to write the results to (default: benchmark/results.json)")
+    args = parser.parse_args()
+
+    sizes = [float(s) for s in args.sizes.split(',')]
+    results = run(sizes, args.repeat)
+    with open(args.out, 'w') as fh:
+        json.dump({'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'repeat': args.repeat,
+                   'results': results}, fh, indent=2)
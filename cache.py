@@ -0,0 +1,194 @@
+"""cache.py
+
+A cache for the output of fastpunct.
+
+The same transcripts tend to get processed many times and each time fastpunct
+would run again on exactly the same segments. The cache stores the raw output of
+the model, keyed on a hash of the text, the model version and the decoding
+settings. There are two tiers: a least-recently-used cache in memory and an
+optional SQLite database on disk that can be shared by several processes. Both
+tiers evict the least recently used entries when they grow over their size
+limit, where size is measured in characters for the memory tier and in bytes of
+stored text for the disk tier.
+
+Note that the cache stores what the model returned and not what the application
+ended up using, so the checks on the output are still applied to cached results.
+
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import collections
+
+
+# Default size limits for the two tiers.
+MEMORY_SIZE = 20_000_000
+DISK_SIZE = 1_000_000_000
+
+# When the disk tier grows over its limit we remove entries until it is at this
+# fraction of the limit, so that eviction does not happen on every write.
+DISK_LOW_WATER = 0.9
+
+# Hits on the disk tier update the time an entry was last used. These updates are
+# kept in memory and written in one transaction when there are USED_BATCH of
+# them or when the oldest is USED_INTERVAL seconds old, and before each write.
+USED_BATCH = 100
+USED_INTERVAL = 10
+
+
+class PunctCache(object):
+
+    def __init__(self, memory_size=MEMORY_SIZE, path=None, disk_size=DISK_SIZE):
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.path = path
+        self.memory = collections.OrderedDict()
+        self.memory_used = 0
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+        self.used = {}
+        self.used_since = None
+
+    def __str__(self):
+        return "<PunctCache items=%d size=%d path=%s>" % (len(self.memory), self.memory_used, self.path)
+
+    def open(self, path, disk_size=None):
+        """Add a disk tier at path, or remove it if path is None."""
+        with self.lock:
+            self.path = path
+            if disk_size is not None:
+                self.disk_size = disk_size
+            self.connection = None
+
+    @staticmethod
+    def key(text, model_version, settings):
+        """Return the key for a text given the model version and the decoding
+        settings, which should be a JSON-serializable dictionary."""
+        data = json.dumps([model_version, settings, text], sort_keys=True)
+        return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached value for the key, or None if it is not cached."""
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.counts['memory_hits'] += 1
+                return value
+            value = self._disk_get(key)
+            if value is not None:
+                self._memory_put(key, value)
+                self.counts['disk_hits'] += 1
+                return value
+            self.counts['misses'] += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self._memory_put(key, value)
+            self._disk_put(key, value)
+
+    def stats(self):
+        """Return a dictionary with hit and miss counts and the sizes of the tiers."""
+        with self.lock:
+            stats = {'memory_hits': self.counts['memory_hits'],
+                     'disk_hits': self.counts['disk_hits'],
+                     'misses': self.counts['misses'],
+                     'memory_items': len(self.memory),
+                     'memory_size': self.memory_used}
+            stats['hits'] = stats['memory_hits'] + stats['disk_hits']
+            return stats
+
+    def _memory_put(self, key, value):
+        if key in self.memory:
+            self.memory_used -= len(self.memory.pop(key))
+        self.memory[key] = value
+        self.memory_used += len(value)
+        while self.memory_used > self.memory_size and self.memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_used -= len(evicted)
+
+    def _db(self):
+        """Return the database connection for this process, or None if there is
+        no disk tier. Connections are not shared with forked processes."""
+        if self.path is None:
+            return None
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS punct "
+                "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS punct_used ON punct (used)")
+            # The total size of the entries is kept in a row of its own, so that
+            # writes do not have to add up the sizes of all entries.
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+            self.connection.execute(
+                "INSERT OR IGNORE INTO meta "
+                "SELECT 'size', COALESCE(SUM(size), 0) FROM punct")
+            self.connection.commit()
+            self.used = {}
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    def _disk_get(self, key):
+        db = self._db()
+        if db is None:
+            return None
+        row = db.execute("SELECT value FROM punct WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if not self.used:
+            self.used_since = now
+        self.used[key] = now
+        if len(self.used) >= USED_BATCH or now - self.used_since >= USED_INTERVAL:
+            self._write_used(db)
+            db.commit()
+        return row[0]
+
+    def _write_used(self, db):
+        """Write the times of the hits that were kept in memory, the caller
+        commits."""
+        if self.used:
+            db.executemany("UPDATE punct SET used = ? WHERE key = ?",
+                           [(used, key) for key, used in self.used.items()])
+            self.used = {}
+
+    def _disk_put(self, key, value):
+        db = self._db()
+        if db is None:
+            return
+        size = len(value.encode('utf8'))
+        # Updating the total first takes the write lock, so the total and the
+        # entries cannot get out of step when several processes write.
+        db.execute("UPDATE meta SET value = value + ? "
+                   "- COALESCE((SELECT size FROM punct WHERE key = ?), 0) WHERE name = 'size'",
+                   (size, key))
+        db.execute("INSERT OR REPLACE INTO punct VALUES (?, ?, ?, ?)",
+                   (key, value, size, time.time()))
+        self._write_used(db)
+        total = db.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+        if total > self.disk_size:
+            self._disk_evict(db, total - int(self.disk_size * DISK_LOW_WATER))
+        db.commit()
+
+    @staticmethod
+    def _disk_evict(db, excess):
+        """Remove least recently used entries until at least excess bytes are gone."""
+        removed = 0
+        keys = []
+        for key, size in db.execute("SELECT key, size FROM punct ORDER BY used"):
+            if removed >= excess:
+                break
+            keys.append((key,))
+            removed += size
+        db.executemany("DELETE FROM punct WHERE key = ?", keys)
+        db.execute("UPDATE meta SET value = value - ? WHERE name = 'size'", (removed,))
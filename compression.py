@@ -0,0 +1,208 @@
+"""compression.py
+
+Compressed MMIF documents.
+
+Kaldi MMIF files repeat the same annotation types and property names for every
+token, and they compress to about a tenth of their size. This module has what
+the server needs for compressed request bodies (the Content-Encoding header) and
+compressed responses (the Accept-Encoding header), and what the command line
+tools need to read and write files that end in .gz or .zst.
+
+Compressed input is read and decompressed a chunk at a time, so the compressed
+data is never in memory all at once next to the decompressed data, and output is
+compressed a chunk at a time as it is generated. Gzip is always available, zstd
+is available if the zstandard package is installed.
+
+"""
+
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Number of bytes read from a compressed stream at a time.
+CHUNK_SIZE = 1 << 16
+
+# Compression levels for responses and for files. These favour speed, the
+# output is written while the client waits for it.
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Encodings in the order they are preferred for responses. Names that clients
+# may use for the same encodings are mapped to these.
+ENCODINGS = ('zstd', 'gzip')
+ALIASES = {'x-gzip': 'gzip'}
+
+# File extensions of compressed files.
+EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# Exceptions raised for data that cannot be decompressed.
+DECOMPRESSION_ERRORS = (zlib.error, EOFError) \
+    + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class UnsupportedEncoding(Exception):
+    """Raised for a content encoding that cannot be handled."""
+
+
+class DecompressionError(ValueError):
+    """Raised for compressed data that cannot be decompressed."""
+
+
+def normalize(encoding):
+    """Return the name of the encoding as used in this module, or None for the
+    identity encoding. Raises UnsupportedEncoding if the encoding is not known or
+    if it is zstd and the zstandard package is not installed."""
+    encoding = (encoding or '').strip().lower()
+    encoding = ALIASES.get(encoding, encoding)
+    if encoding in ('', 'identity'):
+        return None
+    if encoding not in ENCODINGS or not is_available(encoding):
+        raise UnsupportedEncoding("unsupported content encoding '%s'" % encoding)
+    return encoding
+
+
+def is_available(encoding):
+    return encoding == 'gzip' or (encoding == 'zstd' and zstandard is not None)
+
+
+def negotiate(accept_encoding):
+    """Return the encoding to use for a response given the value of the
+    Accept-Encoding header of the request, or None if the response should not be
+    compressed. Encodings with a quality of zero are never picked, and of the
+    others the one with the highest quality wins, with ties going to the
+    encoding that comes first in ENCODINGS. A wildcard stands for all encodings
+    that are not mentioned."""
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.partition(';')
+        name = ALIASES.get(name.strip().lower(), name.strip().lower())
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities[name] = quality
+    candidates = []
+    for rank, encoding in enumerate(ENCODINGS):
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > 0 and is_available(encoding):
+            candidates.append((-quality, rank, encoding))
+    return min(candidates)[2] if candidates else None
+
+
+def decompress_stream(stream, encoding, chunk_size=CHUNK_SIZE):
+    """Read the file-like stream, which has data compressed with the encoding, a
+    chunk at a time and return the decompressed data. Decompressed chunks are
+    added to a single bytearray, which is returned, so the decompressed data is
+    only in memory once. Raises DecompressionError if the data cannot be
+    decompressed."""
+    encoding = normalize(encoding)
+    if encoding is None:
+        return stream.read()
+    decompressor = _Decompressor(encoding)
+    data = bytearray()
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            decompressor.decompress(chunk, data)
+        data += decompressor.flush()
+    except DECOMPRESSION_ERRORS as e:
+        raise DecompressionError("could not decompress %s data (%s)" % (encoding, e))
+    return data
+
+
+def compress_chunks(chunks, encoding):
+    """Generate the compressed version of the chunks, which can be strings or
+    bytes. Strings are encoded as UTF-8."""
+    encoding = normalize(encoding)
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    else:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress(data, encoding):
+    """Return the compressed version of the string or bytes."""
+    return b''.join(compress_chunks([data], encoding))
+
+
+def file_encoding(path):
+    """Return the encoding of a file given its extension, or None if the file is
+    not compressed."""
+    for extension, encoding in EXTENSIONS.items():
+        if path.endswith(extension):
+            return encoding
+    return None
+
+
+def open_file(path, mode='rb', encoding=None):
+    """Open the file, decompressing or compressing it with the encoding. If there
+    is no encoding it is taken from the extension of the file, so that files
+    that end in .gz or .zst are compressed. Text modes use UTF-8."""
+    encoding = normalize(encoding or file_encoding(path))
+    kwargs = {'encoding': 'utf8'} if 't' in mode else {}
+    if encoding == 'gzip':
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL, **kwargs)
+    if encoding == 'zstd':
+        if 'r' in mode:
+            return zstandard.open(path, mode, **kwargs)
+        return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL),
+                              **kwargs)
+    return open(path, mode.replace('t', ''), **kwargs)
+
+
+def read_file(path):
+    """Return the contents of the file as bytes, decompressed if needed."""
+    with open_file(path, 'rb') as fh:
+        return fh.read()
+
+
+class _Decompressor(object):
+
+    """Decompresses data a chunk at a time. The data can have more than one gzip
+    member or zstd frame, which is what you get when compressed files are
+    concatenated, and each of them needs its own decompressor."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.decompressor = self._new()
+        # Whether the current member has started but not ended.
+        self.open = False
+
+    def _new(self):
+        if self.encoding == 'gzip':
+            return zlib.decompressobj(31)
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data, output):
+        """Decompress the data and add the result to the output bytearray."""
+        while data:
+            output += self.decompressor.decompress(data)
+            self.open = not self.decompressor.eof
+            if self.open:
+                break
+            data = self.decompressor.unused_data
+            self.decompressor = self._new()
+
+    def flush(self):
+        if self.open:
+            raise EOFError("compressed data is truncated")
+        return self.decompressor.flush()
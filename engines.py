@@ -0,0 +1,113 @@
+"""engines.py
+
+Engines that run the fastpunct model.
+
+The code in the inference module needs an object with a tokenizer and a model
+that has a generate() method, which is what a FastPunct instance has. An engine
+is such an object with a name, the name is used to select the engine and to keep
+results from different engines apart in the cache.
+
+There are two engines:
+
+    fastpunct   The model as it is loaded by FastPunct, in float32.
+    quantized   The same model with dynamic int8 quantization of all linear
+                layers, which is faster on CPUs and uses less memory. The first
+                time it is used the model is converted and saved next to the
+                fastpunct model files, later the converted model is loaded
+                from there.
+
+To add an engine, subclass FastPunctEngine, override load() and add the class
+to ENGINES.
+
+"""
+
+import os
+
+from model import MODEL_PATH, load_tokenizer
+
+
+# Name of the file with the quantized model, in the directory of the model.
+QUANTIZED_FILE = 'quantized-int8.pt'
+
+
+class FastPunctEngine(object):
+
+    name = 'fastpunct'
+
+    def __init__(self, path=MODEL_PATH):
+        self.path = path
+        self.tokenizer = None
+        self.model = None
+
+    def __str__(self):
+        return "<%s path=%s>" % (self.__class__.__name__, self.path)
+
+    def load(self):
+        """Load the tokenizer and the model, downloading the model files if
+        needed, and return the engine."""
+        from fastpunct import FastPunct
+        fastpunct = FastPunct(checkpoint_local_path=self.path)
+        self.tokenizer = fastpunct.tokenizer
+        self.model = fastpunct.model
+        return self
+
+
+class QuantizedEngine(FastPunctEngine):
+
+    name = 'quantized'
+
+    def load(self):
+        import torch
+        from transformers import T5Config, T5ForConditionalGeneration
+        if not os.path.exists(self.weights()):
+            # This downloads the model files.
+            FastPunctEngine.load(self)
+        self.tokenizer = load_tokenizer(self.path)
+        cached = os.path.join(self.path, QUANTIZED_FILE)
+        fingerprint = self.fingerprint()
+        model = None
+        if os.path.exists(cached):
+            data = torch.load(cached, weights_only=False)
+            if data.get('fingerprint') == fingerprint:
+                # Quantizing an untrained model gives the structure that the
+                # saved weights fit in.
+                config = T5Config.from_pretrained(self.path)
+                model = self.quantize(T5ForConditionalGeneration(config))
+                model.load_state_dict(data['state_dict'])
+        if model is None:
+            model = self.quantize(T5ForConditionalGeneration.from_pretrained(self.path))
+            # Write to a temporary file first since several processes may be
+            # doing this at the same time.
+            tmpfile = "%s.%d.tmp" % (cached, os.getpid())
+            torch.save({'fingerprint': fingerprint, 'state_dict': model.state_dict()}, tmpfile)
+            os.replace(tmpfile, cached)
+        self.model = model.eval()
+        return self
+
+    @staticmethod
+    def quantize(model):
+        import torch
+        return torch.quantization.quantize_dynamic(
+            model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+    def weights(self):
+        return os.path.join(self.path, 'pytorch_model.bin')
+
+    def fingerprint(self):
+        """Return what the saved quantized model depends on, which is the file
+        with the original weights and the torch version."""
+        import torch
+        stat = os.stat(self.weights())
+        return {'size': stat.st_size, 'mtime': stat.st_mtime, 'torch': torch.__version__}
+
+
+ENGINES = {engine.name: engine for engine in (FastPunctEngine, QuantizedEngine)}
+
+DEFAULT_ENGINE = FastPunctEngine.name
+
+
+def create(name=DEFAULT_ENGINE, path=MODEL_PATH):
+    """Return an engine that was not loaded yet."""
+    if name not in ENGINES:
+        raise ValueError("Unknown engine '%s', use one of %s" % (name, ', '.join(ENGINES)))
+    return ENGINES[name](path)
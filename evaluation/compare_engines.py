@@ -0,0 +1,122 @@
+"""compare_engines.py
+
+Usage:
+
+$ python3 compare_engines.py GOLD_TRANSCRIPT...
+$ python3 compare_engines.py --engines fastpunct,quantized --profile fast GOLD_TRANSCRIPT...
+
+Compare the speed and the output of the engines that can run the fastpunct model.
+
+Like evaluate.py this takes gold standard transcripts, removes punctuation and
+capitalization and then has the model restore them. Paragraphs are cut into
+chunks of at most 50 words, which is about the size of the segments that the
+application creates. Each engine is loaded, warmed up and then timed on all
+chunks, and the output is checked in the same way as the application does it.
+
+The output will look like this (numbers are made up)
+
+    engine        load     time   words/s   stripped  restored   vs first
+    fastpunct     3.21    41.07     83.5       1996      1090          0
+    quantized     2.56    17.93    191.2       1996      1112        131
+
+For each engine it shows the following data:
+- the time in seconds to load the engine
+- the time in seconds to run the engine on all chunks
+- the number of words processed per second
+- the edit distance between the gold standard and the stripped text
+- the edit distance between the gold standard and the output of the engine
+- the edit distance between the output of the engine and the output of the first
+  engine
+
+"""
+
+import os
+import sys
+import time
+import argparse
+from curses import ascii
+
+# The application code lives in the main directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import engines
+import inference
+from align import levenshtein_distance
+
+
+CHUNK_SIZE = 50
+
+
+def get_chunks(fnames):
+    """Return pairs of gold standard chunks and stripped chunks."""
+    chunks = []
+    for fname in fnames:
+        for para in open(fname).read().split('\n\n'):
+            words = para.split()
+            for i in range(0, len(words), CHUNK_SIZE):
+                gold = ' '.join(words[i:i+CHUNK_SIZE])
+                chunks.append((gold, strip_punctuation(gold)))
+    return chunks
+
+
+def strip_punctuation(text):
+    tokens = []
+    for token in text.split():
+        token = token.lower()
+        if ascii.ispunct(token[-1]):
+            token = token[:-1]
+        tokens.append(token)
+    return ' '.join(tokens)
+
+
+def check_output(text_in, text_out):
+    # This does the same as the method Segment.set_text_out() in the main
+    # application in ../app.py, with the same settings from the inference module.
+    ratio = len(text_in) / len(text_out) if text_out else 0.0
+    if ratio < inference.FALLBACK_RATIO and len(text_in.split()) > inference.FALLBACK_MIN_WORDS:
+        return text_in
+    return text_out
+
+
+def run_engine(name, stripped, profile):
+    t0 = time.perf_counter()
+    engine = engines.create(name).load()
+    load_time = time.perf_counter() - t0
+    inference.punct(engine, stripped[:1], profile=profile)
+    t0 = time.perf_counter()
+    outputs = inference.punct(engine, stripped, profile=profile)
+    run_time = time.perf_counter() - t0
+    outputs = [check_output(text_in, text_out) for text_in, text_out in zip(stripped, outputs)]
+    return load_time, run_time, outputs
+
+
+def compare(fnames, engine_names, profile):
+    chunks = get_chunks(fnames)
+    gold = [chunk[0] for chunk in chunks]
+    stripped = [chunk[1] for chunk in chunks]
+    words = sum(len(text.split()) for text in stripped)
+    distance_stripped = sum(levenshtein_distance(g, s) for g, s in zip(gold, stripped))
+    print("Comparing engines on %d chunks with %d words...\n" % (len(chunks), words))
+    print("    %-12s %6s %8s %9s %10s %9s %10s"
+          % ('engine', 'load', 'time', 'words/s', 'stripped', 'restored', 'vs first'))
+    first_outputs = None
+    for name in engine_names:
+        load_time, run_time, outputs = run_engine(name, stripped, profile)
+        if first_outputs is None:
+            first_outputs = outputs
+        distance_restored = sum(levenshtein_distance(g, o) for g, o in zip(gold, outputs))
+        distance_first = sum(levenshtein_distance(f, o) for f, o in zip(first_outputs, outputs))
+        print("    %-12s %6.2f %8.2f %9.1f %10d %9d %10d"
+              % (name, load_time, run_time, words / run_time,
+                 distance_stripped, distance_restored, distance_first))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('transcripts', nargs='+', help="gold standard transcripts")
+    parser.add_argument('--engines', default=','.join(engines.ENGINES),
+                        help="comma-separated list of engines, the first one is the reference")
+    parser.add_argument('--profile', choices=list(inference.PROFILES),
+                        default=inference.DEFAULT_PROFILE, help="decoding profile")
+    args = parser.parse_args()
+    compare(args.transcripts, args.engines.split(','), args.profile)
@@ -44,6 +44,10 @@ import os, sys, time, statistics
 from fastpunct import FastPunct
 from curses import ascii
 
+# The edit distance code lives in the main directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from align import levenshtein_distance
+
 print("Loading FastPunct...")
 fp = FastPunct()
 
@@ -127,26 +131,6 @@ def totals_line(results):
                sum([r[5] for r in results])))
 
 
-## Copied from ../align.py
-
-def levenshtein_distance(a, b):
-    """Compute the Levenshtein edit distance between the sequences a and b."""
-    m = len(a) + 1
-    n = len(b) + 1
-    d = [[0]*n for _ in range(m)]
-    for i in range(m): d[i][0] = i  # deletion
-    for j in range(n): d[0][j] = j  # insertion
-    for i in range(1, m):
-        for j in range(1, n):
-            if a[i-1] == b[j-1]:
-                d[i][j] = d[i-1][j-1]
-            else:
-                d[i][j] = min(d[i-1][j] + 1,    # deletion
-                              d[i][j-1] + 1,    # insertion
-                              d[i-1][j-1] + 1)  # substitution
-    return d[m-1][n-1]
-
-
 if __name__ == '__main__':
 
     timestamp = time.strftime("%Y%m%d-%H%M%S")
@@ -0,0 +1,221 @@
+"""inference.py
+
+Batched inference with the fastpunct model.
+
+FastPunct.punct() can take a list of sentences, but it pads the batch without
+handing the attention mask to the model and it uses the length of the longest
+sentence to limit the output of all sentences. So results for a batch can be
+different from the results for the same sentences handed in one by one. The
+code here uses the tokenizer and model of a FastPunct instance directly so that
+batched results are the same as the results from FastPunct.punct() on each
+single sentence.
+
+Decoding is watched by a RunawayDetector, which ends a sentence as soon as it
+reaches its own maximum length (rather than when the longest sentence in the
+batch does), and which stops sentences whose output has become so much longer
+than the input that the application is certain to throw it away and use the
+input instead (see FALLBACK_RATIO below). Those are the sentences where
+fastpunct starts repeating itself, and they are the slowest ones to generate.
+Stopped sentences get an empty string as output.
+
+How the model decodes is set by a profile, which has the number of beams, how
+much longer than the input the output may get, the batch size and whether the
+RunawayDetector stops sentences that run away. The 'balanced' profile decodes
+like fastpunct does, so the application gives the same output as before, only
+faster for sentences that run away. 'fast' allows less room for output and uses
+bigger batches, and 'quality' uses beam search. The RunawayDetector is not used
+with beam search since beams are reordered at each step.
+
+Torch is imported when it is first needed so that importing this module is
+cheap.
+
+"""
+
+import re
+
+from metrics import METRICS
+
+
+# The prefix that fastpunct puts in front of each sentence.
+PREFIX = 'punctuate: '
+
+# Decoding profiles. The maximum length of the output of a sentence is the number
+# of subword tokens of the sentence plus the number of words times extra_per_word
+# plus 4, and with extra_per_word set to 1 this is what fastpunct uses. With
+# stop_runaways the RunawayDetector stops sentences whose output would be thrown
+# away by the application, which does not change what the application returns.
+PROFILES = {
+    'fast': {'num_beams': 1, 'extra_per_word': 0.5, 'batch_size': 32, 'stop_runaways': True},
+    'balanced': {'num_beams': 1, 'extra_per_word': 1.0, 'batch_size': 16, 'stop_runaways': True},
+    'quality': {'num_beams': 4, 'extra_per_word': 1.0, 'batch_size': 8, 'stop_runaways': False},
+}
+DEFAULT_PROFILE = 'balanced'
+
+# The application uses the input instead of the output of fastpunct when the
+# input has more than FALLBACK_MIN_WORDS words and the number of characters of
+# the input divided by that of the output is less than FALLBACK_RATIO. Decoding
+# of a sentence is only stopped when this is certain to happen, that is, when
+# the input is long enough and the output words generated so far already have
+# too many characters.
+FALLBACK_RATIO = 0.95
+FALLBACK_MIN_WORDS = 10
+
+# Characters of output words that are not counted.
+NON_WORD = re.compile(r'\W+')
+
+# Word pieces for each vocabulary, indexed on the tokenizer.
+PIECES = {}
+
+
+def decoding_settings(profile=DEFAULT_PROFILE):
+    """Return the settings that determine the output of the model for a sentence
+    with the profile, this is used by the cache. Note that the batch size is not
+    included since it does not change the output."""
+    settings = {'prefix': PREFIX, 'profile': profile}
+    settings.update(PROFILES[profile])
+    del settings['batch_size']
+    if settings['stop_runaways']:
+        settings.update({'fallback_ratio': FALLBACK_RATIO,
+                         'fallback_min_words': FALLBACK_MIN_WORDS})
+    return settings
+
+
+def punct(fastpunct, sentences, batch_size=None, progress=None, profile=DEFAULT_PROFILE):
+    """Return the punctuated version of all sentences, in the same order as the
+    input. Sentences are sorted on their length in subword tokens and then cut
+    into batches, which means that each batch has sentences of about the same
+    length and only little padding is needed. The batch size is taken from the
+    profile if it is not given. If progress is given it is called with the
+    number of sentences in each batch when that batch is done."""
+    if batch_size is None:
+        batch_size = PROFILES[profile]['batch_size']
+    lengths = [len(fastpunct.tokenizer(PREFIX + s).input_ids) for s in sentences]
+    order = sorted(range(len(sentences)), key=lambda i: lengths[i])
+    results = [None] * len(sentences)
+    for batch in get_batches(order, batch_size):
+        batch_sentences = [sentences[i] for i in batch]
+        batch_lengths = [lengths[i] for i in batch]
+        outputs = punct_batch(fastpunct, batch_sentences, batch_lengths, profile)
+        for i, output in zip(batch, outputs):
+            results[i] = output
+        if progress is not None:
+            progress(len(batch))
+    return results
+
+
+def punct_batch(fastpunct, sentences, lengths, profile=DEFAULT_PROFILE):
+    """Run the model on one batch of sentences, where lengths has the number of
+    subword tokens of each sentence. We generate with the largest maximum length
+    in the batch and then cut each output to the maximum length for that sentence
+    alone, which with the balanced profile is what fastpunct would have used. If
+    the profile uses it, the RunawayDetector ends sentences early and the output
+    is an empty string for sentences that ran away."""
+    import torch
+    settings = PROFILES[profile]
+    encoding = fastpunct.tokenizer(
+        [PREFIX + s for s in sentences], return_tensors="pt", padding=True)
+    max_lengths = [length + int(len(s.split()) * settings['extra_per_word']) + 4
+                   for s, length in zip(sentences, lengths)]
+    detector = None
+    logits_processor = []
+    if settings['stop_runaways']:
+        detector = RunawayDetector(fastpunct.tokenizer, sentences, max_lengths)
+        logits_processor.append(detector)
+    device = fastpunct.model.device
+    with torch.no_grad():
+        output_ids = fastpunct.model.generate(
+            encoding.input_ids.to(device),
+            attention_mask=encoding.attention_mask.to(device),
+            num_beams=settings['num_beams'], max_length=max(max_lengths),
+            logits_processor=logits_processor)
+    stopped = set() if detector is None else detector.stopped
+    if stopped:
+        # Without stopping, the batch would have gone on until the stopped
+        # sentences reached their maximum length.
+        steps = output_ids.shape[1]
+        METRICS.count('runaway_stops', len(stopped))
+        METRICS.count('decode_steps_saved',
+                      max([steps] + [max_lengths[i] for i in stopped]) - steps)
+    return ['' if i in stopped
+            else fastpunct.tokenizer.decode(ids[:max_length], skip_special_tokens=True)
+            for i, (ids, max_length) in enumerate(zip(output_ids, max_lengths))]
+
+
+def normalize(word):
+    return NON_WORD.sub('', word).lower()
+
+
+def get_pieces(tokenizer):
+    """Return a list with for each token identifier whether the token starts a new
+    word and the normalized text of the token. Special tokens have no text since
+    they are not in the decoded output."""
+    pieces = PIECES.get(id(tokenizer))
+    if pieces is None:
+        pieces = []
+        special = set(tokenizer.all_special_ids)
+        for i, piece in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+            piece = '' if piece is None or i in special else piece
+            pieces.append((piece.startswith('\u2581'), normalize(piece)))
+        PIECES[id(tokenizer)] = pieces
+    return pieces
+
+
+class RunawayDetector(object):
+
+    """Logits processor that forces the end-of-sequence token for sentences that
+    reached their maximum length or that ran away. Words of the output are put
+    together from the word pieces that were generated so far, and a sentence ran
+    away when the input has more than FALLBACK_MIN_WORDS words and the output
+    words have more characters than the input divided by FALLBACK_RATIO. Only
+    letters and digits of the output words are counted, so the decoded output is
+    at least that long and the application is certain to use the input instead.
+    The indexes of sentences that ran away are in stopped."""
+
+    def __init__(self, tokenizer, sentences, max_lengths):
+        self.pieces = get_pieces(tokenizer)
+        self.eos = tokenizer.eos_token_id
+        self.max_lengths = max_lengths
+        # Sentences that are too short for the fallback are never stopped.
+        self.max_chars = [len(s) / FALLBACK_RATIO
+                          if len(s.split()) > FALLBACK_MIN_WORDS else float('inf')
+                          for s in sentences]
+        self.chars = [0] * len(sentences)
+        self.current = [''] * len(sentences)
+        self.finished = [False] * len(sentences)
+        self.stopped = set()
+
+    def __call__(self, input_ids, scores):
+        length = input_ids.shape[1]
+        last_tokens = input_ids[:, -1].tolist()
+        for i, token in enumerate(last_tokens):
+            if self.finished[i]:
+                continue
+            # The first position has the decoder start token.
+            if length > 1 and token == self.eos:
+                self.finished[i] = True
+                continue
+            runaway = length > 1 and self.add_piece(i, token)
+            if runaway or length >= self.max_lengths[i]:
+                if runaway:
+                    self.stopped.add(i)
+                self.finished[i] = True
+                scores[i, :] = -float('inf')
+                scores[i, self.eos] = 0
+        return scores
+
+    def add_piece(self, i, token):
+        """Add the word piece to the output of sentence i and return True if the
+        output ran away."""
+        starts_word, text = self.pieces[token] if token < len(self.pieces) else (False, '')
+        if not starts_word:
+            self.current[i] += text
+            return False
+        word = self.current[i]
+        self.current[i] = text
+        self.chars[i] += len(word)
+        return self.chars[i] > self.max_chars[i]
+
+
+def get_batches(elements, batch_size):
+    """Cut a list into lists of batch_size elements (the last one can be shorter)."""
+    return [elements[i:i+batch_size] for i in range(0, len(elements), batch_size)]
@@ -0,0 +1,277 @@
+"""jobs.py
+
+Asynchronous annotation jobs.
+
+Processing a transcript of a few hours takes longer than most proxies and
+gunicorn are willing to wait for a response. With the job interface a client
+submits MMIF and right away gets a job identifier, which it uses to poll the
+status of the job and to fetch the result when the job is done.
+
+Jobs are stored in a SQLite database so that they survive restarts of the
+server and so that all gunicorn workers can share them. Each worker runs one or
+more JobRunner threads that claim queued jobs, shortest input first, and run the
+application on them. While a job runs the runner records how many segments went
+through fastpunct, which doubles as a heartbeat. Jobs whose runner has not been
+heard from for a while (because the worker or the server died) are put back in
+the queue.
+
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+import traceback
+
+
+# A running job that has not been updated for this many seconds is considered
+# abandoned and is queued again.
+LEASE = 600
+
+# A job that was abandoned this many times is not queued again but marked as
+# failed, so that an input that kills the worker does not do so forever.
+MAX_ATTEMPTS = 3
+
+# Seconds a runner sleeps when there are no queued jobs, and the number of
+# seconds between checks for abandoned jobs.
+POLL_INTERVAL = 1.0
+REQUEUE_INTERVAL = 60
+
+# Progress of a running job is written to the database at most this often, in
+# seconds.
+PROGRESS_INTERVAL = 1.0
+
+# Status values of jobs.
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue(object):
+
+    """Jobs in a SQLite database. Each job has the input, the runtime parameters,
+    a status, progress counts and, when it is finished, the result. Inputs are
+    prioritized on their size, which is a good enough proxy for the number of
+    tokens in the input."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+
+    def __str__(self):
+        return "<JobQueue path=%s>" % self.path
+
+    def submit(self, data, params):
+        """Add a job for the input data, which can be a string or bytes, and return
+        the identifier of the job."""
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            db = self._db()
+            db.execute(
+                "INSERT INTO jobs (id, status, priority, params, input, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, len(data), json.dumps(params), data, time.time(), time.time()))
+            db.commit()
+        return job_id
+
+    def get(self, job_id):
+        """Return a dictionary with the status of the job, or None if there is no
+        such job. The input and result are not included."""
+        with self.lock:
+            row = self._db().execute(
+                "SELECT id, status, done, total, error, created, started, finished "
+                "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(('id', 'status', 'done', 'total', 'error',
+                        'created', 'started', 'finished'), row))
+        job['progress'] = {'segments': job.pop('done'), 'total': job.pop('total')}
+        return job
+
+    def result(self, job_id):
+        """Return the status and the result of the job, the result is None if the
+        job is not finished. Returns None if there is no such job."""
+        with self.lock:
+            row = self._db().execute(
+                "SELECT status, result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else tuple(row)
+
+    def delete(self, job_id):
+        """Remove the job and return whether it existed. A running job is removed
+        from the database but it is not stopped."""
+        with self.lock:
+            db = self._db()
+            deleted = db.execute("DELETE FROM jobs WHERE id = ?", (job_id,)).rowcount
+            db.commit()
+        return deleted > 0
+
+    def counts(self):
+        """Return the number of jobs for each status."""
+        with self.lock:
+            rows = self._db().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+            counts = dict(rows.fetchall())
+        return {status: counts.get(status, 0) for status in (QUEUED, RUNNING, DONE, FAILED)}
+
+    def claim(self, runner):
+        """Mark the queued job with the smallest input as running and return its
+        identifier, input and parameters, or None if no job is queued."""
+        with self.lock:
+            db = self._db()
+            # Taking the write lock up front makes sure that two processes do
+            # not claim the same job.
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    "SELECT id, input, params FROM jobs WHERE status = ? "
+                    "ORDER BY priority, created LIMIT 1", (QUEUED,)).fetchone()
+                if row is not None:
+                    now = time.time()
+                    db.execute(
+                        "UPDATE jobs SET status = ?, runner = ?, started = ?, updated = ?, "
+                        "attempts = attempts + 1 WHERE id = ?", (RUNNING, runner, now, now, row[0]))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def progress(self, job_id, done, total):
+        with self.lock:
+            db = self._db()
+            db.execute("UPDATE jobs SET done = ?, total = ?, updated = ? WHERE id = ?",
+                       (done, total, time.time(), job_id))
+            db.commit()
+
+    def finish(self, job_id, result, error=None):
+        """Store the result of the job, which failed if error is not None."""
+        if isinstance(result, str):
+            result = result.encode('utf8')
+        with self.lock:
+            db = self._db()
+            now = time.time()
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, updated = ?, "
+                "input = NULL WHERE id = ?",
+                (DONE if error is None else FAILED, result, error, now, now, job_id))
+            db.commit()
+
+    def requeue_abandoned(self, lease=LEASE):
+        """Put running jobs that were not updated in the last lease seconds back in
+        the queue, or mark them as failed if they were tried too often, and return
+        how many jobs were put back."""
+        now = time.time()
+        with self.lock:
+            db = self._db()
+            db.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ?, updated = ?, input = NULL "
+                "WHERE status = ? AND updated < ? AND attempts >= ?",
+                (FAILED, "job was abandoned %d times" % MAX_ATTEMPTS, now, now,
+                 RUNNING, now - lease, MAX_ATTEMPTS))
+            requeued = db.execute(
+                "UPDATE jobs SET status = ?, runner = NULL, started = NULL, done = 0 "
+                "WHERE status = ? AND updated < ?",
+                (QUEUED, RUNNING, now - lease)).rowcount
+            db.commit()
+        return requeued
+
+    def _db(self):
+        """Return the database connection for this process. Connections are not
+        shared with forked processes."""
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs "
+                "(id TEXT PRIMARY KEY, status TEXT, priority INTEGER, params TEXT, "
+                "input BLOB, result BLOB, error TEXT, done INTEGER DEFAULT 0, "
+                "total INTEGER DEFAULT 0, attempts INTEGER DEFAULT 0, runner TEXT, "
+                "created REAL, started REAL, "
+                "finished REAL, updated REAL)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created)")
+            self.connection.commit()
+            self.connection_pid = os.getpid()
+        return self.connection
+
+
+class JobRunner(object):
+
+    """Runs queued jobs on a background thread. The loader is waited on before
+    any job is claimed, so that jobs are not claimed by a worker that cannot run
+    them."""
+
+    def __init__(self, queue, clams_app, loader, lease=LEASE):
+        self.queue = queue
+        self.clams_app = clams_app
+        self.loader = loader
+        self.lease = lease
+        self.name = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def __str__(self):
+        return "<JobRunner %s>" % self.name
+
+    def start(self):
+        """Start the runner thread, this does nothing if it was already started."""
+        if self.thread is None:
+            # The name identifies the runner in the database, it is set here since
+            # the runner may be created before gunicorn forks its workers.
+            self.name = "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+            self.thread = threading.Thread(target=self._run, name='job-runner', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        self.loader.start()
+        last_requeue = 0
+        while not self.stopped.is_set():
+            if self.loader.status() == 'loading':
+                self.loader.loaded.wait(POLL_INTERVAL)
+                continue
+            if time.time() - last_requeue > REQUEUE_INTERVAL:
+                self.queue.requeue_abandoned(self.lease)
+                last_requeue = time.time()
+            job = self.queue.claim(self.name)
+            if job is None:
+                self.stopped.wait(POLL_INTERVAL)
+                continue
+            self.run_job(*job)
+
+    def run_job(self, job_id, data, params):
+        last_update = 0
+
+        def progress(done, total):
+            # Always write the first and last update, and the ones in between at
+            # most once every PROGRESS_INTERVAL seconds.
+            nonlocal last_update
+            now = time.time()
+            if done in (0, total) or now - last_update >= PROGRESS_INTERVAL:
+                last_update = now
+                self.queue.progress(job_id, done, total)
+
+        try:
+            if self.loader.status() == 'failed':
+                raise RuntimeError("the model could not be loaded (%s)" % self.loader.error)
+            result = self.clams_app.annotate(data, progress=progress, **params)
+            self.queue.finish(job_id, result)
+        except Exception as e:
+            traceback.print_exc()
+            error = "%s: %s" % (e.__class__.__name__, e)
+            try:
+                result = self.clams_app.record_error(data.decode('utf8'), params).serialize(pretty=True)
+            except Exception:
+                result = None
+            self.queue.finish(job_id, result, error=error)
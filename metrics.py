@@ -0,0 +1,166 @@
+"""metrics.py
+
+Timers and counters for the stages of the application.
+
+Timers accumulate the number of times a stage ran and the total time it took,
+counters just count. Both are kept in plain dictionaries in the process that does
+the work and render() writes them out in the Prometheus text format. With several
+gunicorn workers each worker has its own metrics, so the numbers you get from the
+metrics route are for whatever worker answered the request.
+
+Use the timer as a context manager:
+
+    with METRICS.timer('align'):
+        ...
+
+"""
+
+import time
+import threading
+
+
+# Prefix of all metric names.
+NAMESPACE = 'fastpunct'
+
+# Names of the stages, in the order they are printed. Timers with other names
+# are printed after these.
+STAGES = ['annotate', 'parse', 'get_annotations', 'segmentation', 'inference_wait',
+          'queue_wait', 'inference', 'pipeline_wait', 'align', 'fix_errors',
+          'add_annotations', 'serialize']
+
+# Counters and their help text.
+COUNTERS = {
+    'requests': "Annotation requests handled",
+    'errors': "Annotation requests that failed",
+    'views': "Kaldi views processed",
+    'skipped_views': "Kaldi views skipped because they already had a fastpunct view",
+    'tokens': "Kaldi tokens read",
+    'segments': "Segments handed to fastpunct",
+    'ratio_fallbacks': "Segments where fastpunct output was replaced by the input",
+    'local_fixes': "Output words replaced by fix_local_alignment_errors",
+    'none_sequence_deletions': "Output words deleted by fix_none_sequences",
+    'runaway_stops': "Segments where decoding was stopped because the output was certain to be replaced by the input",
+    'decode_steps_saved': "Decoding steps of a batch not taken because sentences in it were stopped",
+    'batches': "Batches run by the batch scheduler",
+    'batch_segments': "Segments in batches run by the batch scheduler",
+    'batch_capacity': "Places for segments in batches run by the batch scheduler",
+}
+
+
+class Timer(object):
+
+    __slots__ = ('metrics', 'stage', 't0')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.stage, time.perf_counter() - self.t0)
+        return False
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = dict.fromkeys(COUNTERS, 0)
+            self.timer_counts = {}
+            self.timer_seconds = {}
+
+    def timer(self, stage):
+        return Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.timer_counts[stage] = self.timer_counts.get(stage, 0) + 1
+            self.timer_seconds[stage] = self.timer_seconds.get(stage, 0.0) + seconds
+
+    def iterate(self, stage, iterable):
+        """Yield the items of the iterable, the time it takes to produce them is
+        added up and observed once for the stage when the iterable is done."""
+        seconds = 0.0
+        iterator = iter(iterable)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - t0
+            yield item
+        self.observe(stage, seconds)
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counts[counter] = self.counts.get(counter, 0) + n
+
+    def snapshot(self):
+        """Return a dictionary with the counters and, for each timer, the number of
+        observations and the total number of seconds."""
+        with self.lock:
+            return {'counters': dict(self.counts),
+                    'timers': {stage: {'count': self.timer_counts[stage],
+                                       'seconds': self.timer_seconds[stage]}
+                               for stage in self.timer_counts}}
+
+    def render(self, cache_stats=None, job_counts=None, memory=None):
+        """Return the metrics in the Prometheus text format. If cache_stats is given
+        it should be what PunctCache.stats() returns, if job_counts is given it
+        should be what JobQueue.counts() returns and if memory is given it should
+        be what model.memory_usage() returns, they are added."""
+        snapshot = self.snapshot()
+        timers = snapshot['timers']
+        lines = []
+        name = '%s_stage_seconds' % NAMESPACE
+        lines.append('# HELP %s Time spent in each stage of the application.' % name)
+        lines.append('# TYPE %s summary' % name)
+        stages = [s for s in STAGES if s in timers] + sorted(s for s in timers if s not in STAGES)
+        for stage in stages:
+            lines.append('%s_count{stage="%s"} %d' % (name, stage, timers[stage]['count']))
+            lines.append('%s_sum{stage="%s"} %.6f' % (name, stage, timers[stage]['seconds']))
+        for counter, value in snapshot['counters'].items():
+            name = '%s_%s_total' % (NAMESPACE, counter)
+            lines.append('# HELP %s %s.' % (name, COUNTERS.get(counter, counter)))
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %d' % (name, value))
+        if cache_stats is not None:
+            name = '%s_cache_requests_total' % NAMESPACE
+            lines.append('# HELP %s Lookups in the fastpunct output cache.' % name)
+            lines.append('# TYPE %s counter' % name)
+            for result in ('memory_hits', 'disk_hits', 'misses'):
+                lines.append('%s{result="%s"} %d' % (name, result, cache_stats[result]))
+            name = '%s_cache_memory_items' % NAMESPACE
+            lines.append('# HELP %s Entries in the memory tier of the cache.' % name)
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %d' % (name, cache_stats['memory_items']))
+            name = '%s_cache_memory_size' % NAMESPACE
+            lines.append('# HELP %s Characters stored in the memory tier of the cache.' % name)
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %d' % (name, cache_stats['memory_size']))
+        if job_counts is not None:
+            name = '%s_jobs' % NAMESPACE
+            lines.append('# HELP %s Jobs in the job queue.' % name)
+            lines.append('# TYPE %s gauge' % name)
+            for status, count in job_counts.items():
+                lines.append('%s{status="%s"} %d' % (name, status, count))
+        if memory is not None:
+            name = '%s_memory_bytes' % NAMESPACE
+            lines.append('# HELP %s Memory used by this process.' % name)
+            lines.append('# TYPE %s gauge' % name)
+            for kind, size in memory.items():
+                lines.append('%s{kind="%s"} %d' % (name, kind, size))
+        return '\n'.join(lines) + '\n'
+
+
+# The metrics of this process.
+METRICS = Metrics()
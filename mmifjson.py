@@ -0,0 +1,198 @@
+"""mmifjson.py
+
+Working with MMIF documents as plain JSON.
+
+Creating a Mmif object builds mmif-python objects for every annotation in every
+view, which for long transcripts takes more time than some of the inference. The
+application only needs to read the annotations in Kaldi views and it needs Mmif
+objects only to add new views. So we parse the JSON once, give mmif-python a
+skeleton of the document where all views have empty annotation lists, and when
+serializing we put the annotations from the input back in.
+
+The output can also be generated in chunks with iter_serialize(), which is used
+for streaming responses. Annotations of new views can then be created while the
+output is written, so the output never has to be in memory all at once. If the
+orjson package is installed it is used to encode the chunks, otherwise the json
+module from the standard library is used.
+
+"""
+
+import json
+
+from mmif.serialize.model import MmifObjectEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Number of annotations in one chunk of streamed output.
+CHUNK_SIZE = 5000
+
+
+class JsonAnnotation(object):
+
+    """An annotation that is stored as the dictionary that ends up in the JSON
+    output. These can be added to the annotations of a View and are then
+    serialized by mmif-python like any other annotation, but they are much
+    cheaper to create than mmif-python Annotations. The properties should
+    include the identifier, which should come last to get the same output as
+    mmif-python Annotations."""
+
+    __slots__ = ('id', 'data')
+
+    def __init__(self, at_type, properties):
+        self.id = properties['id']
+        self.data = {'@type': at_type, 'properties': properties}
+
+    def _serialize(self):
+        return self.data
+
+
+def load(mmif):
+    """Return the MMIF document as a dictionary, the input can be a string, bytes,
+    a bytearray or a dictionary (which is returned as is). Bytes are handed to
+    the json module as they are. This does not use orjson, which is faster but
+    needs about three times as much memory while parsing."""
+    if isinstance(mmif, (str, bytes, bytearray)):
+        mmif = json.loads(mmif)
+    return mmif
+
+
+def skeleton(mmif_json):
+    """Return a copy of the document where all views have an empty list of
+    annotations. Only the top-level dictionary and the view dictionaries are
+    copied, everything else is shared with the input."""
+    copy = dict(mmif_json)
+    copy['views'] = [dict(view, annotations=[]) for view in mmif_json.get('views', [])]
+    return copy
+
+
+def get_views(mmif_json):
+    """Return a dictionary of views from the document, indexed on identifier."""
+    return {view['id']: view for view in mmif_json.get('views', [])}
+
+
+def serialize(mmif_obj, mmif_json, pretty=False):
+    """Serialize the Mmif object, which was created from skeleton(mmif_json) and
+    then possibly had views added to it. Views that were in the input are taken
+    from mmif_json, with their annotations, and new views are taken from the Mmif
+    object."""
+    views_json = get_views(mmif_json)
+    data = mmif_obj._serialize()
+    data['views'] = [views_json.get(view.id, view) for view in mmif_obj.views]
+    return json.dumps(data, indent=2 if pretty else None, cls=MmifObjectEncoder)
+
+
+def iter_serialize(mmif_obj, mmif_json, pending=None, pretty=False, chunk_size=CHUNK_SIZE):
+    """Generate the document that serialize() returns as a sequence of strings,
+    with the annotations of each view in chunks of chunk_size annotations. If
+    pending is given it maps identifiers of new views to iterables of lists of
+    annotations, which are added after the annotations that the view already
+    has. These lists are only taken from the iterable when they are needed. The
+    output has the same content as what serialize() returns, but the formatting
+    can be different."""
+    pending = pending or {}
+    views_json = get_views(mmif_json)
+    data = mmif_obj._serialize()
+    views = [views_json.get(view.id, view) for view in mmif_obj.views]
+    # The views are written by _iter_view(), this keeps their place in the
+    # order of the keys.
+    data['views'] = None
+    level = 1
+    yield '{'
+    for i, (key, value) in enumerate(data.items()):
+        yield _key(key, i, level, pretty)
+        if key != 'views':
+            yield dumps(value, pretty, level)
+            continue
+        if not views:
+            yield '[]'
+            continue
+        yield '['
+        for j, view in enumerate(views):
+            yield ',' if j else ''
+            yield _newline(level + 1, pretty)
+            yield from _iter_view(view, pending, pretty, chunk_size, level + 1)
+        yield _newline(level, pretty) + ']'
+    yield _newline(0, pretty) + '}'
+
+
+def _iter_view(view, pending, pretty, chunk_size, level):
+    """Generate the JSON of a view, which is either a dictionary from the input or
+    a View object."""
+    if isinstance(view, dict):
+        view_data = dict(view)
+        annotations = view_data.get('annotations', [])
+    else:
+        view_data = view._serialize()
+        annotations = view_data.get('annotations', [])
+        if hasattr(annotations, '_serialize'):
+            annotations = annotations._serialize()
+    chunks = _chunks(annotations, pending.get(view_data.get('id'), []), chunk_size)
+    view_data['annotations'] = None
+    yield '{'
+    for i, (key, value) in enumerate(view_data.items()):
+        yield _key(key, i, level + 1, pretty)
+        if key != 'annotations':
+            yield dumps(value, pretty, level + 1)
+            continue
+        empty = True
+        for chunk in chunks:
+            text = dumps(chunk, pretty, level + 1)
+            # Take off the brackets and, with indentation, the newline before
+            # the closing bracket.
+            text = text[1:text.rindex('\n')] if pretty else text[1:-1]
+            yield ('[' if empty else ',') + text
+            empty = False
+        yield '[]' if empty else _newline(level + 1, pretty) + ']'
+    yield _newline(level, pretty) + '}'
+
+
+def _chunks(annotations, pending, chunk_size):
+    """Generate non-empty lists of at most about chunk_size annotations, first
+    from the list of annotations and then from the lists that pending generates."""
+    for i in range(0, len(annotations), chunk_size):
+        yield annotations[i:i+chunk_size]
+    chunk = []
+    for annotations in pending:
+        chunk.extend(annotations)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _key(key, i, level, pretty):
+    return "%s%s%s" % (',' if i else '', _newline(level, pretty),
+                       json.dumps(key) + (': ' if pretty else ':'))
+
+
+def _newline(level, pretty):
+    return '\n' + '  ' * level if pretty else ''
+
+
+def dumps(obj, pretty=False, level=0):
+    """Return the JSON for obj, without any whitespace or with an indentation of
+    two spaces as if obj was nested level deep. Objects from mmif-python and
+    JsonAnnotations are taken care of like MmifObjectEncoder does."""
+    if orjson is not None:
+        text = orjson.dumps(obj, default=_default,
+                            option=orjson.OPT_INDENT_2 if pretty else 0).decode('utf8')
+    else:
+        text = json.dumps(obj, indent=2 if pretty else None,
+                          separators=(',', ': ') if pretty else (',', ':'),
+                          default=_default)
+    if pretty and level:
+        text = text.replace('\n', _newline(level, pretty))
+    return text
+
+
+def _default(obj):
+    if hasattr(obj, '_serialize'):
+        return obj._serialize()
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    return str(obj)
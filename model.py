@@ -0,0 +1,153 @@
+"""model.py
+
+Loading the fastpunct model.
+
+Importing fastpunct pulls in torch and creating a FastPunct instance loads the
+full model, which takes long enough that a server cannot even answer a metadata
+request while it happens. The ModelLoader defined here loads the model on a
+background thread and then runs some warm-up inference so that the first real
+request does not pay for lazy initializations inside torch. What is loaded is
+an engine from the engines module, by default the model as FastPunct loads it.
+
+A loader can also preload the model in the gunicorn master process. Workers that
+are forked from the master then use the model they inherited and share its
+weights with the master and with each other, instead of each loading a copy.
+The memory_usage() function reports how much memory is unique to a process,
+which is how you can check that the sharing works.
+
+"""
+
+import os
+import gc
+import sys
+import time
+import threading
+
+import inference
+
+
+# Text used for warm-up inference after the model is loaded, and the number of
+# times it is run. Setting the number of runs to zero skips the warm-up.
+WARMUP_TEXT = ("good evening i'm jim lehrer on the newshour tonight we have news "
+               "about the tomato it has been observed recently that they dont taste "
+               "good anymore")
+WARMUP_RUNS = 1
+
+# Where fastpunct keeps the English model.
+MODEL_PATH = os.path.join(os.path.expanduser('~'), '.FastPunct_english')
+
+
+def load_tokenizer(path=MODEL_PATH):
+    """Load just the tokenizer of the fastpunct model, for processes that do not
+    load the model themselves. The model files need to be downloaded already."""
+    from transformers import T5Tokenizer
+    return T5Tokenizer.from_pretrained(path)
+
+
+class ModelNotReady(Exception):
+    """Raised when the model is needed but could not be loaded in time."""
+
+
+class ModelLoader(object):
+
+    """Loads an engine on a background thread. The loader remembers the process it
+    was started in so that a process forked from it (for example a gunicorn
+    worker) starts its own loading thread."""
+
+    def __init__(self, warmup_text=WARMUP_TEXT, warmup_runs=WARMUP_RUNS, engine='fastpunct'):
+        self.engine = engine
+        self.warmup_text = warmup_text
+        self.warmup_runs = warmup_runs
+        self.fastpunct = None
+        self.error = None
+        self.load_time = None
+        self.pid = None
+        self.preloaded = False
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+
+    def start(self):
+        """Start loading the model in the background, this does nothing if loading
+        was already started in this process."""
+        with self.lock:
+            if self.pid == os.getpid() or self.preloaded:
+                return
+            self.pid = os.getpid()
+            self.fastpunct = None
+            self.error = None
+            self.loaded = threading.Event()
+            thread = threading.Thread(target=self._load, name='model-loader', daemon=True)
+            thread.start()
+
+    def _load(self):
+        t0 = time.time()
+        try:
+            import engines
+            fastpunct = engines.create(self.engine).load()
+            for _ in range(self.warmup_runs):
+                inference.punct(fastpunct, [self.warmup_text])
+            self.fastpunct = fastpunct
+        except Exception as e:
+            self.error = "%s: %s" % (e.__class__.__name__, e)
+        self.load_time = time.time() - t0
+        self.loaded.set()
+
+    def preload(self):
+        """Load the model in this process and wait for it, processes that are
+        forked from this process later will use this model instead of loading
+        their own. Returns True if the model was loaded."""
+        self.start()
+        self.loaded.wait()
+        if self.error is not None:
+            return False
+        self.preloaded = True
+        # Objects that exist now are never collected, so the garbage collector
+        # does not write to their pages in forked processes.
+        gc.freeze()
+        return True
+
+    def status(self):
+        """Return 'loading', 'ready' or 'failed'."""
+        if not self.loaded.is_set():
+            return 'loading'
+        return 'failed' if self.error is not None else 'ready'
+
+    def is_ready(self):
+        return self.status() == 'ready'
+
+    def get(self, timeout=None):
+        """Return the loaded engine, starting the loading thread if needed and
+        waiting for at most timeout seconds (or forever if timeout is None)."""
+        self.start()
+        if not self.loaded.wait(timeout):
+            raise ModelNotReady("the fastpunct model is still loading")
+        if self.error is not None:
+            raise ModelNotReady("the fastpunct model failed to load (%s)" % self.error)
+        return self.fastpunct
+
+
+def memory_usage():
+    """Return a dictionary with the resident set size, the proportional set size
+    and the unique set size of this process in bytes, or None if this is not
+    available. The unique set size is the memory that would be freed if the
+    process exited, pages shared with other processes are not part of it."""
+    try:
+        with open('/proc/self/smaps_rollup') as fh:
+            fields = dict(line.split(':', 1) for line in fh if ':' in line)
+    except OSError:
+        return None
+    def size(name):
+        return int(fields.get(name, '0 kB').split()[0]) * 1024
+    return {'rss': size('Rss'), 'pss': size('Pss'),
+            'uss': size('Private_Clean') + size('Private_Dirty')}
+
+
+def report_memory(loader):
+    """Wait until the loader is done and print the memory usage of this process."""
+    loader.loaded.wait()
+    usage = memory_usage()
+    if usage is None:
+        return
+    print("process %d, model %s: rss %.1f MB, pss %.1f MB, uss %.1f MB"
+          % (os.getpid(), loader.status(), usage['rss'] / 1e6, usage['pss'] / 1e6,
+             usage['uss'] / 1e6), file=sys.stderr, flush=True)
@@ -0,0 +1,268 @@
+"""pool.py
+
+A pool of fastpunct model replicas in separate processes.
+
+Torch does not scale well over many threads for the short sequences that we
+hand to fastpunct, so on a machine with many cores it is better to run a few
+replicas of the model with a few threads each than to run one replica with all
+threads. Each replica runs in its own process, loads its own model, limits the
+number of torch threads and pins itself to its own set of CPUs. Replicas take
+batches of sentences from a shared task queue and put results on a shared result
+queue, from where a collector thread hands them back to the request that asked
+for them.
+
+The pool can be used in the same way as a ModelLoader from the model module
+when it comes to starting up and checking whether it is ready.
+
+The collector thread also checks that the replicas are still alive. A replica
+that dies (for example because it was killed when memory ran out) takes the
+batch it was working on with it, and it may leave the task queue unusable, so
+the pool is then marked as failed. Requests that are waiting fail with an error
+and so do all later requests, and the readiness route reports the failure.
+
+"""
+
+import os
+import time
+import queue
+import itertools
+import threading
+import traceback
+import multiprocessing
+
+import inference
+from metrics import METRICS
+
+
+# Default number of torch threads per replica.
+THREADS_PER_REPLICA = 4
+
+# Seconds between checks on whether the replicas are still alive.
+CHECK_INTERVAL = 1.0
+
+
+def available_cpus():
+    """Return the list of CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def default_layout(replicas=None, threads=None):
+    """Return the number of replicas and threads per replica, filling in
+    whatever is not given from the number of available CPUs."""
+    cpus = len(available_cpus())
+    if threads is None:
+        threads = min(THREADS_PER_REPLICA, cpus)
+        if replicas is not None:
+            threads = max(1, min(threads, cpus // replicas))
+    if replicas is None:
+        replicas = max(1, cpus // threads)
+    return replicas, threads
+
+
+class ReplicaPool(object):
+
+    def __init__(self, replicas=None, threads=None, engine='fastpunct'):
+        self.replicas, self.threads = default_layout(replicas, threads)
+        self.engine = engine
+        self.processes = []
+        self.tasks = None
+        self.results = None
+        self.pending = {}
+        self.request_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.ready_replicas = 0
+        self.error = None
+        self.load_time = None
+        self.started = None
+        self.stopping = False
+
+    def __str__(self):
+        return "<ReplicaPool replicas=%d threads=%d status=%s>" \
+            % (self.replicas, self.threads, self.status())
+
+    def start(self):
+        """Start the replica processes and the collector thread, this does nothing
+        if the pool was already started."""
+        with self.lock:
+            if self.started is not None:
+                return
+            self.started = time.time()
+            context = multiprocessing.get_context('spawn')
+            self.tasks = context.Queue()
+            self.results = context.Queue()
+            cpus = available_cpus()
+            for i in range(self.replicas):
+                # Wrap around if there are fewer CPUs than replicas times threads.
+                replica_cpus = [cpus[(i * self.threads + t) % len(cpus)]
+                                for t in range(self.threads)]
+                process = context.Process(
+                    target=run_replica, name='fastpunct-replica-%d' % i, daemon=True,
+                    args=(replica_cpus, self.threads, self.engine, self.tasks, self.results))
+                process.start()
+                self.processes.append(process)
+            threading.Thread(target=self._collect, name='replica-collector', daemon=True).start()
+
+    def stop(self):
+        self.stopping = True
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+
+    def status(self):
+        if not self.loaded.is_set():
+            return 'loading'
+        return 'failed' if self.error is not None else 'ready'
+
+    def is_ready(self):
+        return self.status() == 'ready'
+
+    def get(self, timeout=None):
+        """Wait for all replicas to load their model and return the pool."""
+        from model import ModelNotReady
+        self.start()
+        if not self.loaded.wait(timeout):
+            raise ModelNotReady("the fastpunct replicas are still loading")
+        if self.error is not None:
+            raise ModelNotReady("a fastpunct replica failed (%s)" % self.error)
+        return self
+
+    def punct(self, sentences, batch_size=None, progress=None, profile=inference.DEFAULT_PROFILE):
+        """Return the punctuated version of all sentences, in the same order as the
+        input. Sentences are sorted on length and cut into batches, and batches
+        are spread over the replicas, the batch size is taken from the decoding
+        profile if it is not given. If progress is given it is called from the
+        collector thread with the number of sentences in each finished batch."""
+        self.get()
+        if batch_size is None:
+            batch_size = inference.PROFILES[profile]['batch_size']
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+        batches = inference.get_batches(order, batch_size)
+        request_id = next(self.request_ids)
+        request = {'results': [None] * len(batches), 'remaining': len(batches),
+                   'error': None, 'done': threading.Event(), 'progress': progress}
+        with self.lock:
+            # The collector fails pending requests when a replica dies, so a
+            # request cannot be added after that.
+            if self.error is not None:
+                raise RuntimeError("fastpunct replica failed: %s" % self.error)
+            self.pending[request_id] = request
+        for batch_number, batch in enumerate(batches):
+            self.tasks.put((request_id, batch_number, [sentences[i] for i in batch], profile))
+        if batches:
+            request['done'].wait()
+        with self.lock:
+            del self.pending[request_id]
+        if request['error'] is not None:
+            raise RuntimeError("fastpunct replica failed: %s" % request['error'])
+        results = [None] * len(sentences)
+        for batch, outputs in zip(batches, request['results']):
+            for i, output in zip(batch, outputs):
+                results[i] = output
+        return results
+
+    def _collect(self):
+        """Take messages from the result queue and hand them to whoever is
+        waiting for them. Every CHECK_INTERVAL seconds this also checks whether
+        the replicas are still alive."""
+        last_check = time.time()
+        while True:
+            if time.time() - last_check >= CHECK_INTERVAL:
+                self._check_replicas()
+                last_check = time.time()
+            try:
+                message = self.results.get(timeout=CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            kind = message[0]
+            if kind == 'ready':
+                self.ready_replicas += 1
+                if self.ready_replicas == self.replicas:
+                    self.load_time = time.time() - self.started
+                    self.loaded.set()
+            elif kind == 'failed':
+                self.error = message[1]
+                self.load_time = time.time() - self.started
+                self.loaded.set()
+            else:
+                _, request_id, batch_number, outputs, error, counts = message
+                # Counters from inference in the replica are added to the
+                # metrics of this process.
+                for counter, n in counts.items():
+                    METRICS.count(counter, n)
+                with self.lock:
+                    request = self.pending.get(request_id)
+                if request is None:
+                    continue
+                request['results'][batch_number] = outputs
+                request['error'] = request['error'] or error
+                request['remaining'] -= 1
+                if request['progress'] is not None and outputs is not None:
+                    # This thread serves all requests, so it should not be taken
+                    # down by a failing progress callback. Progress is only
+                    # reported, so the request itself goes on.
+                    try:
+                        request['progress'](len(outputs))
+                    except Exception:
+                        traceback.print_exc()
+                if request['remaining'] == 0:
+                    request['done'].set()
+
+    def _check_replicas(self):
+        """Mark the pool as failed and fail all waiting requests if a replica
+        died."""
+        if self.stopping or self.error is not None:
+            return
+        dead = [process for process in self.processes if not process.is_alive()]
+        if not dead:
+            return
+        error = "replica %s exited with code %s" % (dead[0].name, dead[0].exitcode)
+        with self.lock:
+            self.error = error
+            requests = list(self.pending.values())
+        for request in requests:
+            request['error'] = request['error'] or error
+            request['done'].set()
+        if not self.loaded.is_set():
+            self.load_time = time.time() - self.started
+            self.loaded.set()
+
+
+def run_replica(cpus, threads, engine, tasks, results):
+    """Main function of a replica process."""
+    # This needs to be done before torch is imported.
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    import torch
+    import model
+    torch.set_num_threads(threads)
+    loader = model.ModelLoader(engine=engine)
+    try:
+        fastpunct = loader.get()
+    except model.ModelNotReady as e:
+        results.put(('failed', str(e)))
+        return
+    results.put(('ready', os.getpid()))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        request_id, batch_number, sentences, profile = task
+        METRICS.reset()
+        try:
+            outputs = inference.punct(fastpunct, sentences, batch_size=len(sentences),
+                                      profile=profile)
+            results.put(('result', request_id, batch_number, outputs, None, replica_counts()))
+        except Exception as e:
+            results.put(('result', request_id, batch_number, None,
+                         "%s: %s" % (e.__class__.__name__, e), replica_counts()))
+
+
+def replica_counts():
+    """Return the counters of the replica that are not zero."""
+    counters = METRICS.snapshot()['counters']
+    return {counter: n for counter, n in counters.items() if n}
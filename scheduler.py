@@ -0,0 +1,195 @@
+"""scheduler.py
+
+Batching segments from concurrent requests.
+
+When several requests run at the same time in one process (see the --threads
+option of app.py) each request hands its own segments to the model, which under
+load gives many small batches that run at the same time and compete for the
+CPUs. The BatchScheduler instead puts the segments of all requests on a shared
+queue, and a single thread takes batches from that queue, runs them on the model
+and hands each result back to the request that owns the segment.
+
+A batch is taken from the queue as soon as it is full, which is when it has the
+batch size of its decoding profile or when adding the next segment would make it
+go over the token budget, or when the oldest segment in the queue has waited for
+max_wait seconds. The cost of a batch is its number of segments times the number
+of subword tokens of its longest segment, since that is what the model computes
+on after padding. Segments are taken in the order they were queued, and the
+segments of a request are queued all at once and sorted on length. So segments
+that are queued later never go before a segment that is waiting, which bounds
+how long a request waits. Segments with different decoding profiles cannot go
+in the same batch, so each profile has its own queue and the queue with the
+oldest segment goes first.
+
+The scheduler reports the time segments wait in the queue as the queue_wait
+stage, and counters for the number of batches and for the number of segments
+and the number of places in those batches, the fill rate is the number of
+segments divided by the number of places.
+
+"""
+
+import os
+import time
+import threading
+import collections
+
+import inference
+from metrics import METRICS
+
+
+# Maximum time in seconds that the oldest segment in the queue waits for a batch
+# to fill up.
+MAX_WAIT = 0.02
+
+# Maximum cost of a batch in subword tokens after padding, with None only the
+# batch size of the decoding profile limits a batch.
+TOKEN_BUDGET = None
+
+
+class BatchScheduler(object):
+
+    """Runs segments from all requests in shared batches on the engine from a
+    model loader, with the same punct() method as the ReplicaPool."""
+
+    def __init__(self, loader, max_wait=MAX_WAIT, token_budget=TOKEN_BUDGET, batch_size=None):
+        self.loader = loader
+        self.max_wait = max_wait
+        self.token_budget = token_budget
+        self.batch_size = batch_size
+        self.queues = {profile: collections.deque() for profile in inference.PROFILES}
+        self.condition = threading.Condition()
+        self.pid = None
+
+    def __str__(self):
+        return "<BatchScheduler max_wait=%s token_budget=%s queued=%d>" \
+            % (self.max_wait, self.token_budget, sum(len(q) for q in self.queues.values()))
+
+    @property
+    def engine(self):
+        return self.loader.engine
+
+    def start(self):
+        """Start the scheduler thread, this does nothing if it was already started
+        in this process."""
+        with self.condition:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queues = {profile: collections.deque() for profile in inference.PROFILES}
+            threading.Thread(target=self._run, name='batch-scheduler', daemon=True).start()
+
+    def get(self, timeout=None):
+        self.loader.get(timeout)
+        self.start()
+        return self
+
+    def punct(self, sentences, batch_size=None, progress=None, profile=inference.DEFAULT_PROFILE):
+        """Return the punctuated version of all sentences, in the same order as the
+        input. The sentences are queued and this waits until the scheduler has
+        run all of them. The batch size is ignored since batches are shared with
+        other requests. If progress is given it is called from the scheduler
+        thread with the number of sentences of this request in each finished
+        batch."""
+        if not sentences:
+            return []
+        tokenizer = self.loader.get().tokenizer
+        self.start()
+        lengths = [len(tokenizer(inference.PREFIX + s).input_ids) for s in sentences]
+        request = {'results': [None] * len(sentences), 'remaining': len(sentences),
+                   'progress': progress, 'error': None, 'done': threading.Event()}
+        queued = time.monotonic()
+        with self.condition:
+            queue = self.queues[profile]
+            for i in sorted(range(len(sentences)), key=lambda i: lengths[i]):
+                queue.append((request, i, sentences[i], lengths[i], queued))
+            self.condition.notify()
+        request['done'].wait()
+        if request['error'] is not None:
+            raise RuntimeError("inference failed (%s)" % request['error'])
+        return request['results']
+
+    def _run(self):
+        while True:
+            profile, batch, capacity = self._next_batch()
+            self._run_batch(profile, batch, capacity)
+
+    def _next_batch(self):
+        """Wait for a batch and take it from its queue. Returns the profile, the
+        queued items in the batch and the batch size."""
+        with self.condition:
+            while True:
+                waiting = [(queue[0][4], profile)
+                           for profile, queue in self.queues.items() if queue]
+                if not waiting:
+                    self.condition.wait()
+                    continue
+                oldest, profile = min(waiting)
+                size, full = self._fill(profile)
+                remaining = oldest + self.max_wait - time.monotonic()
+                if full or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            queue = self.queues[profile]
+            batch = [queue.popleft() for _ in range(size)]
+        return profile, batch, self._capacity(profile)
+
+    def _fill(self, profile):
+        """Return the number of items from the front of the queue of the profile
+        that go in the next batch and whether that batch is full."""
+        queue = self.queues[profile]
+        capacity = self._capacity(profile)
+        longest = 0
+        size = 0
+        for item in queue:
+            if size == capacity:
+                return size, True
+            longest = max(longest, item[3])
+            if size > 0 and self.token_budget is not None \
+                    and longest * (size + 1) > self.token_budget:
+                return size, True
+            size += 1
+        return size, size == capacity
+
+    def _capacity(self, profile):
+        return self.batch_size or inference.PROFILES[profile]['batch_size']
+
+    def _run_batch(self, profile, batch, capacity):
+        # Segments of requests that already failed are dropped.
+        batch = [item for item in batch if item[0]['error'] is None]
+        if not batch:
+            return
+        now = time.monotonic()
+        for item in batch:
+            METRICS.observe('queue_wait', now - item[4])
+        METRICS.count('batches')
+        METRICS.count('batch_segments', len(batch))
+        METRICS.count('batch_capacity', capacity)
+        error = None
+        try:
+            outputs = inference.punct_batch(
+                self.loader.get(), [item[2] for item in batch], [item[3] for item in batch],
+                profile)
+        except Exception as e:
+            error = "%s: %s" % (e.__class__.__name__, e)
+            outputs = [None] * len(batch)
+        # The number of sentences of each request in this batch.
+        counts = collections.OrderedDict()
+        for item, output in zip(batch, outputs):
+            request = item[0]
+            request['results'][item[1]] = output
+            counts[id(request)] = [request, counts.get(id(request), [None, 0])[1] + 1]
+        for request, n in counts.values():
+            request['remaining'] -= n
+            if error is not None:
+                request['error'] = error
+                request['done'].set()
+                continue
+            if request['progress'] is not None:
+                # The scheduler thread serves all requests, so it should not be
+                # taken down by a failing progress callback.
+                try:
+                    request['progress'](n)
+                except Exception:
+                    pass
+            if request['remaining'] == 0:
+                request['done'].set()
@@ -0,0 +1,192 @@
+"""server.py
+
+Additions to the Flask application that is created by the Restifier.
+
+The Restifier maps GET and POST on the root to the metadata and annotate methods
+of the application. Here we add a liveness route (/health) that answers as soon
+as the server is up, a readiness route (/ready) that tells whether annotation
+requests can be served, and a check in front of annotation requests that waits
+for the model to load or returns a 503 response if that takes too long. Timers
+and counters from the metrics module are available in the Prometheus text format
+on the metrics route (/metrics).
+
+When a job queue is given there are also routes for asynchronous jobs:
+
+    POST   /jobs               submit MMIF, returns the job identifier
+    GET    /jobs/<id>          status and progress of the job
+    GET    /jobs/<id>/result   the output MMIF of a finished job
+    DELETE /jobs/<id>          remove the job
+
+We also take over annotation requests from the Restifier. The Restifier turns
+the request body into a Mmif object before handing it to the application, which
+means that the application cannot use its faster path for JSON strings. By
+default the output is streamed as a chunked response, which starts as soon as
+inference and alignment are done and which means that the output does not have
+to be in memory all at once.
+
+Request bodies of annotation requests and job submissions can be compressed with
+gzip or zstd, as given by the Content-Encoding header, and the MMIF in responses
+is compressed if the Accept-Encoding header of the request allows it.
+
+"""
+
+import json
+
+from flask import request, Response
+from clams.restify import ParameterCaster
+
+import compression
+from model import ModelNotReady, memory_usage
+from metrics import METRICS
+
+
+# How long an annotation request waits for the model to load before it gets a
+# 503 response. With zero the request gets the 503 right away.
+MODEL_WAIT = 60
+
+
+def add_routes(flask_app, clams_app, loader, model_wait=MODEL_WAIT, cache=None, jobs=None,
+               stream=True, compress=True):
+    """Add the health, readiness and metrics routes to the Flask application,
+    make annotation requests wait for the model loaded by the loader, and hand
+    the request body of annotation requests to the CLAMS application as is. If a
+    cache is given its statistics are added to the metrics, and if a job queue is
+    given the job routes are added. With stream set the output of annotation
+    requests is streamed, and with compress set MMIF responses are compressed
+    for clients that accept that."""
+
+    param_caster = ParameterCaster(clams_app.annotate_param_spec)
+
+    def response_encoding():
+        if not compress:
+            return None
+        return compression.negotiate(request.headers.get('Accept-Encoding'))
+
+    @flask_app.route('/health', methods=['GET'])
+    def health():
+        return json_response({'status': 'ok'})
+
+    @flask_app.route('/ready', methods=['GET'])
+    def ready():
+        loader.start()
+        status = loader.status()
+        answer = {'status': status}
+        if status == 'failed':
+            answer['error'] = loader.error
+        elif status == 'ready':
+            answer['load_time'] = round(loader.load_time, 3)
+        return json_response(answer, 200 if status == 'ready' else 503)
+
+    @flask_app.route('/metrics', methods=['GET'])
+    def metrics():
+        cache_stats = cache.stats() if cache is not None else None
+        job_counts = jobs.counts() if jobs is not None else None
+        text = METRICS.render(cache_stats, job_counts, memory_usage())
+        return Response(response=text, status=200, mimetype='text/plain; version=0.0.4')
+
+    if jobs is not None:
+        add_job_routes(flask_app, jobs, param_caster, response_encoding)
+
+    @flask_app.before_request
+    def annotate():
+        # Returning a response here means that the Restifier never sees the
+        # request.
+        if request.path == '/' and request.method in ('POST', 'PUT'):
+            try:
+                loader.get(timeout=model_wait)
+            except ModelNotReady as e:
+                response = json_response({'status': loader.status(), 'error': str(e)}, 503)
+                response.headers['Retry-After'] = '10'
+                return response
+            data, error = read_body()
+            if error is not None:
+                return error
+            params = param_caster.cast(request.args)
+            encoding = response_encoding()
+            try:
+                if stream:
+                    return mmif_response(clams_app.annotate_stream(data, **params),
+                                         encoding=encoding)
+                return mmif_response(clams_app.annotate(data, **params), encoding=encoding)
+            except Exception:
+                METRICS.count('errors')
+                return mmif_response(
+                    clams_app.record_error(data.decode('utf8'), params).serialize(pretty=True), 500)
+
+
+def add_job_routes(flask_app, jobs, param_caster, response_encoding):
+    """Add routes to submit jobs to the queue and to get their status and results.
+    Jobs are run by the JobRunners of the workers, not by these routes. The
+    response_encoding function returns the encoding for results."""
+
+    @flask_app.route('/jobs', methods=['POST'])
+    def submit_job():
+        params = param_caster.cast(request.args)
+        data, error = read_body()
+        if error is not None:
+            return error
+        job_id = jobs.submit(data, params)
+        response = json_response(jobs.get(job_id), 202)
+        response.headers['Location'] = '/jobs/%s' % job_id
+        return response
+
+    @flask_app.route('/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            return json_response({'error': 'no such job'}, 404)
+        return json_response(job)
+
+    @flask_app.route('/jobs/<job_id>/result', methods=['GET'])
+    def job_result(job_id):
+        result = jobs.result(job_id)
+        if result is None:
+            return json_response({'error': 'no such job'}, 404)
+        status, output = result
+        if output is None:
+            if status == 'failed':
+                return json_response(jobs.get(job_id), 500)
+            return json_response({'status': status, 'error': 'job is not finished'}, 409)
+        return mmif_response(output, 200 if status == 'done' else 500,
+                             encoding=response_encoding())
+
+    @flask_app.route('/jobs/<job_id>', methods=['DELETE'])
+    def delete_job(job_id):
+        if not jobs.delete(job_id):
+            return json_response({'error': 'no such job'}, 404)
+        return json_response({'id': job_id, 'status': 'deleted'})
+
+
+def json_response(obj, status=200):
+    return Response(response=json.dumps(obj), status=status, mimetype='application/json')
+
+
+def read_body():
+    """Return the body of the request as bytes (or a bytearray if it was
+    decompressed, see compression.decompress_stream()) and None. If the body cannot be decompressed then
+    None and an error response are returned."""
+    encoding = request.headers.get('Content-Encoding')
+    if not encoding:
+        return request.get_data(), None
+    try:
+        return compression.decompress_stream(request.stream, encoding), None
+    except compression.UnsupportedEncoding as e:
+        return None, json_response({'error': str(e)}, 415)
+    except compression.DecompressionError as e:
+        return None, json_response({'error': str(e)}, 400)
+
+
+def mmif_response(mmif, status=200, encoding=None):
+    """Return a response with the MMIF, which is a string, bytes or an iterator
+    of strings that is sent as a chunked response. If an encoding is given the MMIF
+    is compressed with it."""
+    if encoding is not None:
+        if isinstance(mmif, (str, bytes)):
+            mmif = compression.compress(mmif, encoding)
+        else:
+            mmif = compression.compress_chunks(mmif, encoding)
+    response = Response(response=mmif, status=status, mimetype='application/json')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+    return response
@@ -4,11 +4,17 @@ Several tests and experiments for this application.
 
 $ python test.py example-mmif.json out.json
 Run fastpunct on an input MMIF file. This bypasses the server and just pings the
-annotate() method on the App class. Output is written to out.json.
+annotate() method on the App class. Output is written to out.json. Files that
+end in .gz or .zst are decompressed when read and compressed when written.
 
 $ python test.py --duplicates
 Run the code that finds duplicates on an example.
 
+$ python test.py --alignment
+Check on random sequences that fast_align() and align_indexes() give the same
+alignments as the original Needleman-Wunsch implementation in align(), with and
+without a band.
+
 $ python test.py --metadata
 Prints the metadata.
 
@@ -16,10 +22,13 @@ Prints the metadata.
 
 import sys
 import json
+import random
 import mmif
 import app
+import compression
 import evaluation.examples
-from align import align
+import align
+from align import align_indexes
 
 app.PRINT_PROGRESS = True
 app.PRINT_ERROR_FIXES = True
@@ -31,27 +40,80 @@ def test_fixing_duplication_errors():
     print('>>> testing duplication error fix')
     segment_in = evaluation.examples.segment_with_duplicates_in
     segment_out = evaluation.examples.segment_with_duplicates_out
-    words_in_aligned, words_out_aligned = align(segment_in.split(), segment_out.split())
-    app.fix_errors(list(zip(words_in_aligned, words_out_aligned)))
+    words_in = segment_in.split()
+    words_out = segment_out.split()
+    indexes_in, indexes_out = align_indexes(words_in, words_out)
+    app.fix_errors(words_in, words_out, indexes_in, indexes_out)
+
+def test_alignment(runs=2000, seed=1):
+    print('>>> testing numpy and banded alignment against align()')
+    rng = random.Random(seed)
+    checked = banded = 0
+    # Some inputs that are easy to get wrong, followed by random ones.
+    pairs = [('', ''), ('abc', ''), ('', 'abc'), ('a', 'a'), ('a', 'b'),
+             ('abcdef', 'abcdef'), ('aaaa', 'aa'), ('ab', 'baaaab')]
+    for _ in range(runs):
+        alphabet = 'ab' if rng.random() < 0.5 else 'abcdef'
+        pairs.append((''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 12))),
+                      ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))))
+    for a, b in pairs:
+        m, n = len(a), len(b)
+        # Aligning the indexes gives the path of the original implementation.
+        path = align.align(list(range(m)), list(range(n)), s=lambda i, j: a[i] == b[j],
+                           gap=align.GAP)
+        assert align.fast_align(a, b) == align.align(a, b), (a, b)
+        assert align.fast_align(list(a), list(b), s=lambda x, y: 2 * (x == y) - 1,
+                                key=str.upper) \
+            == align.align(list(a), list(b), s=lambda x, y: 2 * (x == y) - 1,
+                           key=str.upper), (a, b)
+        assert align_indexes(a, b) == path, (a, b)
+        for band in range(max(m, n) + 2):
+            # The band is around the range of diagonals between 0 and n - m.
+            lowest = min(0, n - m) - band
+            highest = max(0, n - m) + band
+            indexes = align_indexes(a, b, band=band)
+            if in_band(path, lowest, highest):
+                assert indexes == path, (a, b, band)
+                banded += 1
+            else:
+                assert in_band(indexes, lowest, highest), (a, b, band)
+                assert alignment_score(a, b, indexes) <= alignment_score(a, b, path)
+        checked += 1
+    print('    %d pairs, %d banded alignments equal to align()' % (checked, banded))
+
+def in_band(indexes, lowest, highest):
+    # Walks the cells of the alignment and checks their diagonal.
+    i = j = 0
+    for index_a, index_b in zip(*indexes):
+        i += index_a != align.GAP
+        j += index_b != align.GAP
+        if not lowest <= j - i <= highest:
+            return False
+    return True
+
+def alignment_score(a, b, indexes, d=-5):
+    return sum(d if align.GAP in (i, j) else a[i] == b[j] for i, j in zip(*indexes))
 
 def print_metadata():
     meta = application.appmetadata()
     print(json.dumps(json.loads(meta), indent=4))
 
 def run_tool(in_file, out_file):
-    with open(in_file) as fh_in, open(out_file, 'w') as fh_out:
-        mmif_out_as_string = application.annotate(fh_in.read(), pretty=True)
-        mmif_out = mmif.Mmif(mmif_out_as_string)
+    mmif_out_as_string = application.annotate(compression.read_file(in_file), pretty=True)
+    with compression.open_file(out_file, 'wt') as fh_out:
         fh_out.write(mmif_out_as_string)
-        for view in mmif_out.views:
-            print("VIEW: <View id=%s annotations=%s app=%s>"
-                  % (view.id, len(view.annotations), view.metadata['app']))
+    mmif_out = mmif.Mmif(mmif_out_as_string)
+    for view in mmif_out.views:
+        print("VIEW: <View id=%s annotations=%s app=%s>"
+              % (view.id, len(view.annotations), view.metadata['app']))
 
 
 if __name__ == '__main__':
 
     if sys.argv[1] == '--duplicates':
         test_fixing_duplication_errors()
+    elif sys.argv[1] == '--alignment':
+        test_alignment()
     elif sys.argv[1] == '--metadata':
         print_metadata()
     else:
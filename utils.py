@@ -3,22 +3,26 @@ import collections
 
 class Identifiers(object):
 
-    """Utility class to generate annotation identifiers. You could, but don't have
-    to, reset this each time you start a new view. This works only for new views
-    since it does not check for identifiers of annotations already in the list
-    of annotations."""
-
-    identifiers = collections.defaultdict(int)
-
-    @classmethod
-    def new(cls, prefix):
-        cls.identifiers[prefix] += 1
-        return "%s%d" % (prefix, cls.identifiers[prefix])
-
-    @classmethod
-    def reset(cls):
-        cls.identifiers = collections.defaultdict(int)
-
-
-
-
+    """Utility class to generate annotation identifiers. Each request creates its
+    own instance so that requests that run at the same time do not share
+    counters. You could, but don't have to, reset this each time you start a new
+    view. This works only for new views since it does not check for identifiers
+    of annotations already in the list of annotations."""
+
+    def __init__(self):
+        self.identifiers = collections.defaultdict(int)
+
+    def new(self, prefix):
+        self.identifiers[prefix] += 1
+        return "%s%d" % (prefix, self.identifiers[prefix])
+
+    def reserve(self, prefix, n):
+        """Reserve n identifiers with the prefix and return the number of the first
+        one, so the identifiers are prefix followed by that number up to that
+        number plus n minus one."""
+        first = self.identifiers[prefix] + 1
+        self.identifiers[prefix] += n
+        return first
+
+    def reset(self):
+        self.identifiers = collections.defaultdict(int)